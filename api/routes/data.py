@@ -66,28 +66,42 @@ def get_hist_data():
   """
   Retrieves a list of coins either between a start and end date or all the coins available in the History DB
   """
+  from models.pgportfolio.marketdata.globaldatamatrix import history_table, HistoryManager, ROLLUP_MIGRATION
+
   startdate: str = request.json['startdate']
   enddate: str = request.json['enddate']
   coinliststr: str = request.json['coinlist'].strip()
+  # candle period in seconds, coarser periods are read from their rollup table
+  period: int = int(request.json.get('period') or 300)
 
   if len(coinliststr) > 0:
     coinlist = coinliststr.split(',')
   else:
     coinlist = []
 
+  try:
+    table = history_table(period)
+  except ValueError as e:
+    return {'hist_data': [], 'error_msg': str(e)}
+  # the rollups of a history stored before they existed are missing until the migration is run
+  if table != history_table(300) and not HistoryManager.migration_completed(ROLLUP_MIGRATION):
+    return {'hist_data': [], 'error_msg': f'the {period}s candles are not built yet, run `python main.py --mode=migrate_db` or use the 300s period'}
+  # rollup rows are dated by the end of their bucket, shift them so every table reports the candle start
+  date_offset = 0 if period == 300 else period
+
   db = MariaDB()
 
   where_date_clause = ''
   if startdate != '':
     startdate_dt = dateutil.parser.isoparse(startdate)
     startdate_unix = int(time.mktime(startdate_dt.timetuple()))
-    where_date_clause += f' and `date` >= {startdate_unix}'
+    where_date_clause += f' and `date` >= {startdate_unix + date_offset}'
 
   if enddate != '':
     enddate_dt = dateutil.parser.isoparse(enddate)
     enddate_unix = int(time.mktime(enddate_dt.timetuple()))
     logger.info(f'enddate_unix: {enddate_unix}')
-    where_date_clause += f' and `date` <= {enddate_unix}'
+    where_date_clause += f' and `date` <= {enddate_unix + date_offset}'
 
   where_coin_clause = ''
   if len(coinlist) > 0:
@@ -95,7 +109,7 @@ def get_hist_data():
     where_coin_clause = f' and coin in ({coins_as_str})'
 
   qry = f"""       
-    select `date`, FROM_UNIXTIME(date, '%%Y-%%m-%%d %%H:%%i:%%S') AS isodate, coin, high, low, open, close, volume, quoteVolume, weightedAverage from Mkt_History_Px
+    select `date` - {date_offset} AS `date`, FROM_UNIXTIME(`date` - {date_offset}, '%%Y-%%m-%%d %%H:%%i:%%S') AS isodate, coin, high, low, open, close, volume, quoteVolume, weightedAverage from {table}
     WHERE coin != ''
     {where_coin_clause}
     {where_date_clause}
@@ -27,7 +27,7 @@ def build_parser() -> ArgumentParser:
       dest="mode",
       metavar="MODE",
       default=" ",
-      help="start mode, train, generate, download_data, backtest, save_test_data, plot, table, cleanup_training, cleanup_generate_train",
+      help="start mode, train, generate, download_data, migrate_db, backtest, save_test_data, plot, table, cleanup_training, cleanup_generate_train",
   )
   # additional arguments
   parser.add_argument("--processes", dest="processes", default="1", help="number of processes you want to start to train the network")
@@ -97,6 +97,12 @@ def main():
         portion_reversed=config["input"]["portion_reversed"],
     )
 
+  elif options.mode == "migrate_db":
+    from models.pgportfolio.marketdata.globaldatamatrix import HistoryManager
+
+    logging.basicConfig(level=logging.INFO)
+    HistoryManager(coin_number=0, end=time.time(), online=False).migrate_db()
+
   elif options.mode == "backtest":
     config = _config_by_algo(options.algo)
     _set_logging_by_algo(logging.DEBUG, logging.DEBUG, options.algo, "backtestlog")
@@ -2,10 +2,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
+import json
 import os
 import time
+import logging.handlers
 from multiprocessing import Process, Queue
-from models.pgportfolio.learn.tradertrainer import TraderTrainer
+from models.pgportfolio.learn.tradertrainer import TraderTrainer, KERAS_AGENT, create_agent
+from models.pgportfolio.marketdata.datamatrices import DataMatrices
 from models.pgportfolio.tools.configprocess import load_config
 import logging
 from common.custom_logger2 import get_custom_logger, get_custom_training_logger, global_training_queue
@@ -14,7 +18,7 @@ logger = get_custom_logger(__name__)
 training_logger = get_custom_training_logger(__name__)
 
 
-def train_one(save_path: str, config: str, log_file_dir: str, index: str, logfile_level: int, console_level: int, device: str, logging_q: Queue):
+def train_one(save_path: str, config: str, log_file_dir: str, index: str, logfile_level: int, console_level: int, device: str, logging_q: Queue, global_data: dict = None):
   """
 
     train an agent
@@ -27,6 +31,7 @@ def train_one(save_path: str, config: str, log_file_dir: str, index: str, logfil
         logfile_level (int): logging level of the file
         console_level (int): logging level of the console
         device (str):  'cpu' or 'gpu' 
+        global_data (dict, optional): the global data shared by train_all, see DataMatrices.share_global_data. Defaults to None.
 
     Returns:
         [type]: the Result namedtuple
@@ -43,15 +48,74 @@ def train_one(save_path: str, config: str, log_file_dir: str, index: str, logfil
   # training_logger.info("training_logger: RUNNING IN PROCESS!!!!!")
   # training_logger.info("logger %s started" % index)
 
-  TraderTrainer(config, save_path=save_path, device=device, logging_q=logging_q).train_net(log_file_dir=log_file_dir, index=index)
+  TraderTrainer(config, save_path=save_path, device=device, logging_q=logging_q, global_data=global_data).train_net(log_file_dir=log_file_dir, index=index)
 
   logger.info("Training complete")
 
 
+def train_ensemble(config: dict, package_dir: str, dirs: list, logging_q: Queue):
+  """
+
+    train the agents of several train_package folders at once, as the replicas of a single ensemble
+
+    The folders must share the configuration but for their random seed, which is read from their net_config.json.
+    Each replica is saved to the netfile of its folder in the checkpoint format of KerasAgent, so the agent_type of
+    every net_config.json is set to KerasAgent for the backtests to restore it. Each replica is then restored, evaluated
+    and backtested by a TraderTrainer, and its Result is saved like the ones of train_one.
+
+    Args:
+        config (dict): the configuration shared by the folders
+        package_dir (str): the train_package directory
+        dirs (list): the names of the folders to train
+        logging_q (Queue): the threadsafe queue used to push logging message
+    """
+  # imported in the training process only, like the agents of TraderTrainer
+  from models.pgportfolio.learn.ensemble import train_ensemble as train_seeds
+
+  logging.getLogger().addHandler(logging.handlers.QueueHandler(logging_q))
+  seeds = []
+  for dir in dirs:
+    config_path = os.path.join(package_dir, dir, "net_config.json")
+    with open(config_path) as f:
+      net_config = json.load(f)
+    seeds.append(net_config["random_seed"])
+    if net_config.get("agent_type") != KERAS_AGENT:
+      logger.warning(f"train_package {dir}: the ensemble trains a {KERAS_AGENT}, not a {net_config.get('agent_type')}, its net_config.json is updated")
+      net_config["agent_type"] = KERAS_AGENT
+      with open(config_path, "w") as f:
+        json.dump(net_config, f, indent=4, sort_keys=True)
+  start_time = time.time()
+  save_paths = [os.path.join(package_dir, dir, "netfile") for dir in dirs]
+  matrices = DataMatrices.create_from_config(config)
+  pvms = train_seeds(config, seeds, save_paths, matrices)
+  training_time = time.time() - start_time
+
+  results = []
+  for dir, seed, save_path, pvm in zip(dirs, seeds, save_paths, pvms):
+    seed_config = copy.deepcopy(config)
+    seed_config["random_seed"] = seed
+    seed_config["agent_type"] = KERAS_AGENT
+    # each replica is evaluated and backtested over its own indices, replay buffer and PVM, the global data is shared
+    seed_matrices = DataMatrices.create_from_config(seed_config, global_data=matrices.global_data)
+    # the test set is evaluated from the portfolio vector memory of the replica, as at the end of its training
+    seed_matrices.pvm[:] = pvm
+    trainer = TraderTrainer(seed_config, save_path=save_path, agent=create_agent(seed_config, restore_dir=save_path), data_matrices=seed_matrices)
+    results.append(trainer.evaluate_result(dir, training_time))
+  trainer.save_results(results)
+  # marks the folders as trained for train_all
+  for dir in dirs:
+    os.makedirs(os.path.join(package_dir, dir, "tensorboard"), exist_ok=True)
+  logger.info("Ensemble training complete")
+
+
 def train_all(config: dict, processes: int = 1, device: str = "cpu"):
   """
 
     Train all the agents in the train_package folders
+
+    The global data matrix is loaded once and shared read only with the training processes, each process only
+    allocates its own portfolio vector memory and replay buffer. If training.ensemble, the folders are instead
+    trained together in a single process, see train_ensemble.
  
     Args:
         config (dict): object containing the training input parameters for the training session
@@ -76,8 +140,21 @@ def train_all(config: dict, processes: int = 1, device: str = "cpu"):
     os.makedirs(package_dir)
   all_subdir = os.listdir(package_dir)
   all_subdir.sort()
+  if config["training"]["ensemble"]:
+    dirs = [
+        dir for dir in all_subdir if str.isdigit(dir) and os.path.isdir(os.path.join(package_dir, dir)) and
+        not (os.path.isdir(os.path.join(package_dir, dir, "tensorboard")) or os.path.isdir(os.path.join(package_dir, dir, "logfile")))
+    ]
+    if dirs:
+      p = Process(target=train_ensemble, args=(config, package_dir, dirs, global_training_queue))
+      p.start()
+      p.join()
+    print("All the Tasks are Over")
+    return ("OK", "All the Tasks are Over")
   pool = []
   status_msg = ''
+  shared_data = None
+  global_data = None
   for dir in all_subdir:
     if os.path.isdir(os.path.join(package_dir, dir)) == False:  #i.e. if the dir is not actually a dir
       continue
@@ -85,15 +162,18 @@ def train_all(config: dict, processes: int = 1, device: str = "cpu"):
     logger.info(f'processing dir: {dir}')
     if not str.isdigit(dir):
       logger.info(f'dir [{dir}] is not numeric')
+      _release_shared_data(pool, shared_data)
       return
     # NOTE: logfile is for compatibility reason.
     # We dont need to train if already trained.
     if not (os.path.isdir(os.path.join(package_dir, dir, "tensorboard")) or os.path.isdir(os.path.join(package_dir, dir, "logfile"))):
+      if shared_data is None:
+        shared_data, global_data = DataMatrices.create_from_config(config).share_global_data()
       p = Process(
           target=train_one,
           args=(os.path.join(package_dir, dir,
                              "netfile"), config, os.path.join(package_dir, dir,
-                                                              "tensorboard"), dir, logfile_level, console_level, device, global_training_queue),
+                                                              "tensorboard"), dir, logfile_level, console_level, device, global_training_queue, global_data),
       )
       p.start()
       pool.append(p)
@@ -111,6 +191,15 @@ def train_all(config: dict, processes: int = 1, device: str = "cpu"):
           pool.remove(p)
       if len(pool) < processes:
         wait = False
+  _release_shared_data(pool, shared_data)
   print("All the Tasks are Over")
 
   return ("OK", (status_msg if status_msg == '' else "All the Tasks are Over"))
+
+
+def _release_shared_data(pool: list, shared_data) -> None:
+  """frees the shared global data once every training process using it is over"""
+  for p in pool:
+    p.join()
+  if shared_data is not None:
+    shared_data.close()
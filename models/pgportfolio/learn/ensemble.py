@@ -0,0 +1,140 @@
+from __future__ import absolute_import, division, print_function
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from models.pgportfolio.learn.kerasagent import (LOSS, PORTFOLIO_VALUE, PORTFOLIO_WEIGHTS, LOG_MEAN, LOG_MEAN_FREE,
+                                                 build_model, check_eager_execution, create_loss_function, create_optimizer,
+                                                 portfolio_metrics)
+from models.pgportfolio.marketdata.datamatrices import DataMatrices
+
+from common.custom_logger2 import get_custom_logger
+
+logger = get_custom_logger(__name__)
+
+# the metrics reported per seed
+ENSEMBLE_METRICS = (PORTFOLIO_VALUE, LOG_MEAN, LOG_MEAN_FREE, LOSS)
+
+
+class EnsembleAgent:
+  """
+
+    K replicas of the KerasAgent network, one per random seed, trained together by a single compiled step.
+
+    The replicas share the input batch (X and y) but each one reads its own last_w from its own portfolio vector
+    memory. Their losses are summed, so every replica gets the gradient of its own loss, and the optimizer keeps
+    per-variable state, so it updates them independently. The checkpoints of every replica can be restored by a
+    KerasAgent.
+
+    Args:
+        config (dict): the config dictionary, shared by all the replicas but for the random seed
+        seeds (list): the random seed of every replica
+    """
+
+  def __init__(self, config, seeds):
+    check_eager_execution()
+    self._seeds = list(seeds)
+    self._commission_ratio = config["trading"]["trading_consumption"]
+    self._models = []
+    for seed in self._seeds:
+      tf.random.set_seed(seed)
+      self._models.append(build_model(config["input"]["feature_number"], config["input"]["coin_number"], config["input"]["window_size"], config["layers"]))
+    self._loss_function = create_loss_function(config["training"]["loss_function"], self._commission_ratio)
+    self._optimizer = create_optimizer(config["training"])
+
+    feature_number, coin_number = config["input"]["feature_number"], config["input"]["coin_number"]
+    signature = [tf.TensorSpec([None, feature_number, coin_number, config["input"]["window_size"]], tf.float32),
+                 tf.TensorSpec([None, feature_number, coin_number], tf.float32),
+                 tf.TensorSpec([len(self._seeds), None, coin_number], tf.float32)]
+    jit_compile = bool(config["training"]["xla"])
+    self._train_step = tf.function(self._train_step_fn, input_signature=signature, jit_compile=jit_compile)
+    self._evaluate = tf.function(self._evaluate_fn, input_signature=signature, jit_compile=jit_compile)
+    logger.info(f"ensemble of {len(self._seeds)} replicas, seeds {self._seeds}")
+
+  @property
+  def seeds(self):
+    return self._seeds
+
+  def _metrics(self, x, y, last_w, training):
+    metrics = [
+        portfolio_metrics(model([x, last_w[k]], training=training), y, last_w[k], self._commission_ratio, self._loss_function, model.losses)
+        for k, model in enumerate(self._models)
+    ]
+    return {name: tf.stack([m[name] for m in metrics]) for name in ENSEMBLE_METRICS + (PORTFOLIO_WEIGHTS,)}
+
+  def _train_step_fn(self, x, y, last_w):
+    variables = [variable for model in self._models for variable in model.trainable_variables]
+    with tf.GradientTape() as tape:
+      metrics = self._metrics(x, y, last_w, training=True)
+    self._optimizer.apply_gradients(zip(tape.gradient(tf.reduce_sum(metrics[LOSS]), variables), variables))
+    return metrics[PORTFOLIO_WEIGHTS]
+
+  def _evaluate_fn(self, x, y, last_w):
+    return self._metrics(x, y, last_w, training=False)
+
+  def train(self, x, y, last_w) -> np.ndarray:
+    """trains every replica on the batch, last_w being [replicas, batch, assets], returns the output weights [replicas, batch, assets + 1]"""
+    return self._train_step(x, y, last_w).numpy()
+
+  def evaluate(self, x, y, last_w) -> dict:
+    """returns the ENSEMBLE_METRICS and the PORTFOLIO_WEIGHTS of every replica, stacked along the first axis"""
+    return {name: value.numpy() for name, value in self._evaluate(x, y, last_w).items()}
+
+  def save_model(self, replica: int, path: str) -> None:
+    """saves the variables of a replica, in the checkpoint format of KerasAgent"""
+    tf.train.Checkpoint(model=self._models[replica]).write(path)
+
+
+def train_ensemble(config: dict, seeds: list, save_paths: list, matrices: DataMatrices) -> list:
+  """
+
+    Trains the network of config for every seed at once with an EnsembleAgent, over a single DataMatrices whose
+    batches are shared by all the seeds. Every seed has its own portfolio vector memory.
+
+    The test set is evaluated every 1000 steps. A replica is saved to its save path whenever its test portfolio value
+    improves if training.snap_shot, at every evaluation otherwise, like TraderTrainer does.
+
+    Args:
+        config (dict): the config dictionary
+        seeds (list): the random seed of every replica
+        save_paths (list): the checkpoint path of every replica, e.g. the netfile of its train_package folder
+        matrices (DataMatrices): the data matrices of config, their own portfolio vector memory is left as is
+
+    Returns:
+        list: the portfolio vector memory [time, assets] of every seed, in the order of seeds
+    """
+  start_time = time.time()
+  np.random.seed(config["random_seed"])
+  train_config = config["training"]
+  matrices.check_nan()
+  agent = EnsembleAgent(config, seeds)
+  # one portfolio vector memory per seed, [seed, time, assets]
+  pvm = np.repeat(matrices.pvm[np.newaxis], len(seeds), axis=0)
+  test_set = matrices.get_test_set()
+  best_pv = np.zeros(len(seeds))
+
+  def evaluate_test_set():
+    indexs = test_set["indexs"]
+    metrics = agent.evaluate(test_set["X"], test_set["y"], pvm[:, indexs - 1])
+    pvm[:, indexs] = metrics[PORTFOLIO_WEIGHTS][:, :, 1:]
+    return metrics
+
+  for step in range(train_config["steps"]):
+    batch = matrices.next_batch(with_last_w=False)
+    indexs = batch["indexs"]
+    pvm[:, indexs] = agent.train(batch["X"], batch["y"], pvm[:, indexs - 1])[:, :, 1:]
+    if step % 1000 == 0:
+      metrics = evaluate_test_set()
+      for k, seed in enumerate(seeds):
+        logger.info(f"Step: {step} / {train_config['steps']} seed {seed}: the portfolio value on the test is "
+                    f"{metrics[PORTFOLIO_VALUE][k]}, log_mean is {metrics[LOG_MEAN][k]}, loss is {metrics[LOSS][k]}")
+        if not train_config["snap_shot"]:
+          agent.save_model(k, save_paths[k])
+        elif metrics[PORTFOLIO_VALUE][k] > best_pv[k]:
+          best_pv[k] = metrics[PORTFOLIO_VALUE][k]
+          agent.save_model(k, save_paths[k])
+
+  metrics = evaluate_test_set()
+  logger.warning(f"trained {len(seeds)} seeds in {time.time() - start_time:.0f} seconds, test portfolio values {metrics[PORTFOLIO_VALUE]}")
+  return list(pvm)
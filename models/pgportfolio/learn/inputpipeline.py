@@ -0,0 +1,57 @@
+from __future__ import absolute_import, division, print_function
+import tensorflow.compat.v1 as tf
+
+from common.custom_logger2 import get_custom_logger
+
+logger = get_custom_logger(__name__)
+
+# the batches are fed to the placeholders of the network at every session.run
+FEED_DICT = "feed_dict"
+# the batches are read by the graph from a tf.data pipeline, see build_dataset_inputs
+DATASET = "dataset"
+INPUT_PIPELINES = (FEED_DICT, DATASET)
+
+
+def build_dataset_inputs(matrices, feature_number: int, coin_number: int, window_size: int, depth: int = 2) -> dict:
+  """
+
+    Builds a tf.data pipeline over the training batches of a DataMatrices, in the default graph.
+
+    A generator samples the replay buffer and packs X and y, which are prefetched by up to depth batches while the
+    current one is trained. last_w is read from the portfolio vector memory (PVM) by a numpy_function when the batch
+    is consumed, i.e. after the weights of the previous batch were written back, so the batches are the ones the
+    feed_dict path would build. The indexs of the batch are part of its tensors, so that the output weights can be
+    fetched along with them and written back with DataMatrices.write_w.
+
+    The global data is checked for nan once here instead of at every step.
+
+    Args:
+        matrices (DataMatrices): the data matrices to take the batches from
+        feature_number (int): the number of features of X
+        coin_number (int): the number of coins of X
+        window_size (int): the window size of X
+        depth (int, optional): the number of batches prefetched. Defaults to 2.
+
+    Returns:
+        dict: the "iterator", which must be initialized in the session, and the "indexs", "x", "y" and "last_w"
+        tensors of its next batch
+    """
+  matrices.check_nan()
+
+  def batches():
+    while True:
+      batch = matrices.next_batch(with_last_w=False)
+      yield batch["indexs"], batch["X"], batch["y"]
+
+  dataset = tf.data.Dataset.from_generator(batches,
+                                           output_types=(tf.int64, tf.float32, tf.float32),
+                                           output_shapes=(tf.TensorShape([None]),
+                                                          tf.TensorShape([None, feature_number, coin_number, window_size]),
+                                                          tf.TensorShape([None, feature_number, coin_number])))
+  dataset = dataset.prefetch(max(1, int(depth)))
+  iterator = tf.data.make_initializable_iterator(dataset)
+  indexs, x, y = iterator.get_next()
+  last_w = tf.numpy_function(matrices.read_last_w, [indexs], tf.float32)
+  last_w.set_shape([None, coin_number])
+  logger.info(f"training batches read from a tf.data pipeline prefetching {max(1, int(depth))} batches")
+  return {"iterator": iterator, "indexs": indexs, "x": x, "y": y, "last_w": last_w}
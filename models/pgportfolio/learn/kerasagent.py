@@ -0,0 +1,305 @@
+from __future__ import absolute_import, print_function, division
+import tensorflow as tf
+import numpy as np
+from models.pgportfolio.constants import LAMBDA
+
+from common.custom_logger2 import get_custom_logger
+
+logger = get_custom_logger(__name__)
+
+# the metrics evaluate_tensors can compute, returned by the properties of the same name
+PORTFOLIO_VALUE = "portfolio_value"
+LOG_MEAN = "log_mean"
+LOG_MEAN_FREE = "log_mean_free"
+PV_VECTOR = "pv_vector"
+PORTFOLIO_WEIGHTS = "portfolio_weights"
+STANDARD_DEVIATION = "standard_deviation"
+SHARP_RATIO = "sharp_ratio"
+LOSS = "loss"
+
+REGULARIZERS = {"L2": tf.keras.regularizers.l2, "L1": tf.keras.regularizers.l1, "L1L2": tf.keras.regularizers.l1_l2}
+
+
+def check_eager_execution():
+    """raises a RuntimeError if the TF2 behavior of the process was disabled, which the Keras models need"""
+    if not tf.executing_eagerly():
+        raise RuntimeError("the TF2 behavior was disabled in this process, e.g. by importing network.py for an NNAgent, "
+                           "a KerasAgent can not be built in it. Train the KerasAgent in a process which does not use NNAgent")
+
+
+class KerasAgent:
+    """
+    The EIIE network of NNAgent as a TF2 Keras model, trained by a tf.function compiled step instead of a
+    tf.compat.v1 session. It reads the same layers, input and training config, computes the same metrics and losses
+    (loss_function4 to loss_function8) and has the same interface as NNAgent, so TraderTrainer can use either one.
+
+    It must run in a process where network.py was not imported, as that module disables the TF2 behavior. The
+    metric "tensors" are names, evaluated by evaluate_tensors, and its checkpoints are not compatible with the ones
+    of NNAgent. It does not support the tf.data input pipeline nor the tensorboard summaries.
+    """
+
+    def __init__(self, config, restore_dir=None, device="cpu"):
+        """
+        :param config: config dictionary, training.xla enables the XLA JIT compilation of the steps
+        :param restore_dir: path of a checkpoint written by save_model
+        """
+        check_eager_execution()
+        self.__config = config
+        self.__coin_number = config["input"]["coin_number"]
+        self.__commission_ratio = config["trading"]["trading_consumption"]
+        tf.random.set_seed(config["random_seed"])
+        self.__model = build_model(config["input"]["feature_number"],
+                                   self.__coin_number,
+                                   config["input"]["window_size"],
+                                   config["layers"])
+        self.__loss_function = create_loss_function(config["training"]["loss_function"], self.__commission_ratio)
+        self.__optimizer = create_optimizer(config["training"])
+        self.__checkpoint = tf.train.Checkpoint(model=self.__model, optimizer=self.__optimizer)
+        if restore_dir:
+            self.__checkpoint.read(restore_dir).expect_partial()
+
+        signature = [tf.TensorSpec([None, config["input"]["feature_number"], self.__coin_number, config["input"]["window_size"]], tf.float32),
+                     tf.TensorSpec([None, config["input"]["feature_number"], self.__coin_number], tf.float32),
+                     tf.TensorSpec([None, self.__coin_number], tf.float32)]
+        jit_compile = bool(config["training"]["xla"])
+        self.__train_step = tf.function(self.__train_step_fn, input_signature=signature, jit_compile=jit_compile)
+        self.__evaluate = tf.function(self.__evaluate_fn, input_signature=signature, jit_compile=jit_compile)
+        self.__decide = tf.function(lambda x, last_w: self.__model([x, last_w], training=False), input_signature=[signature[0], signature[2]])
+        logger.info(f"keras agent with {self.__model.count_params()} parameters, xla {jit_compile}")
+
+    @property
+    def model(self):
+        return self.__model
+
+    @property
+    def pv_vector(self):
+        return PV_VECTOR
+
+    @property
+    def standard_deviation(self):
+        return STANDARD_DEVIATION
+
+    @property
+    def portfolio_weights(self):
+        return PORTFOLIO_WEIGHTS
+
+    @property
+    def sharp_ratio(self):
+        return SHARP_RATIO
+
+    @property
+    def log_mean(self):
+        return LOG_MEAN
+
+    @property
+    def log_mean_free(self):
+        return LOG_MEAN_FREE
+
+    @property
+    def portfolio_value(self):
+        return PORTFOLIO_VALUE
+
+    @property
+    def loss(self):
+        return LOSS
+
+    @property
+    def has_input_pipeline(self):
+        return False
+
+    @property
+    def layers_dict(self):
+        return {}
+
+    def recycle(self):
+        tf.keras.backend.clear_session()
+
+    def __train_step_fn(self, x, y, last_w):
+        with tf.GradientTape() as tape:
+            output = self.__model([x, last_w], training=True)
+            metrics = portfolio_metrics(output, y, last_w, self.__commission_ratio, self.__loss_function, self.__model.losses)
+        variables = self.__model.trainable_variables
+        self.__optimizer.apply_gradients(zip(tape.gradient(metrics[LOSS], variables), variables))
+        return output
+
+    def __evaluate_fn(self, x, y, last_w):
+        return portfolio_metrics(self.__model([x, last_w], training=False), y, last_w, self.__commission_ratio,
+                                 self.__loss_function, self.__model.losses)
+
+    def train(self, x, y, last_w, setw, check_nan=True):
+        if check_nan:
+            assert not np.any(np.isnan(x))
+            assert not np.any(np.isnan(y))
+        assert not np.any(np.isnan(last_w)), "the last_w is {}".format(last_w)
+        setw(self.__train_step(x, y, last_w).numpy()[:, 1:])
+
+    def evaluate_tensors(self, x, y, last_w, setw, tensors, check_nan=True):
+        """
+        :param setw: a function, pass the output w to it to fill the PVM
+        :param tensors: the metrics to compute, e.g. agent.portfolio_value. Others, e.g. a summary, evaluate to None
+        :param check_nan: if False x and y are not checked for nan
+        :return: the values of tensors
+        """
+        if check_nan:
+            assert not np.any(np.isnan(x))
+            assert not np.any(np.isnan(y))
+        assert not np.any(np.isnan(last_w)), "the last_w is {}".format(last_w)
+        metrics = self.__evaluate(x, y, last_w)
+        setw(metrics[PORTFOLIO_WEIGHTS].numpy()[:, 1:])
+        return [metrics[tensor].numpy() if isinstance(tensor, str) and tensor in metrics else None for tensor in tensors]
+
+    # save the variables path including file name
+    def save_model(self, path):
+        self.__checkpoint.write(path)
+
+    def snapshot_variables(self):
+        """returns the values of the variables of the model, which restore_variables assigns back without any disk I/O"""
+        return [(variable, variable.numpy()) for variable in self.__model.variables]
+
+    def restore_variables(self, snapshot):
+        for variable, value in snapshot:
+            variable.assign(value)
+
+    # the history is a 3d matrix, return a asset vector
+    def decide_by_history(self, history, last_w):
+        assert isinstance(history, np.ndarray),\
+            "the history should be a numpy array, not %s" % type(history)
+        assert not np.any(np.isnan(last_w))
+        assert not np.any(np.isnan(history))
+        history = history[np.newaxis, :, :, :].astype(np.float32)
+        return np.squeeze(self.__decide(history, last_w[np.newaxis, 1:].astype(np.float32)).numpy())
+
+
+def portfolio_metrics(output, y, last_w, commission_ratio, loss_function, regularization_losses=()):
+    """
+    the metrics of NNAgent for the output weights of a batch
+    :param output: the portfolio weights [batch, assets + 1]
+    :param loss_function: a function of create_loss_function
+    :param regularization_losses: the regularization losses of the model, added to the loss
+    :return: a dictionary of the metrics by name
+    """
+    future_price = tf.concat([tf.ones_like(output[:, :1]), y[:, 0, :]], 1)
+    growth = tf.reduce_sum(output * future_price, axis=1)
+    future_omega = (future_price * output) / growth[:, None]
+    # consumption vector (on each periods)
+    w_t = future_omega[:-1]  # rebalanced
+    w_t1 = output[1:]
+    pure_pc = 1 - tf.reduce_sum(tf.abs(w_t1[:, 1:] - w_t[:, 1:]), axis=1) * commission_ratio
+    pv_vector = growth * tf.concat([tf.ones(1), pure_pc], axis=0)
+    mean = tf.reduce_mean(pv_vector)
+    standard_deviation = tf.sqrt(tf.reduce_mean((pv_vector - mean)**2))
+    return {
+        PORTFOLIO_WEIGHTS: output,
+        PV_VECTOR: pv_vector,
+        PORTFOLIO_VALUE: tf.reduce_prod(pv_vector),
+        LOG_MEAN: tf.reduce_mean(tf.math.log(pv_vector)),
+        LOG_MEAN_FREE: tf.reduce_mean(tf.math.log(growth)),
+        STANDARD_DEVIATION: standard_deviation,
+        SHARP_RATIO: (mean - 1) / standard_deviation,
+        LOSS: loss_function(output, future_price, pv_vector, last_w) + tf.add_n([tf.constant(0.0)] + list(regularization_losses)),
+    }
+
+
+def create_loss_function(name, commission_ratio):
+    """returns the loss function (output, future_price, pv_vector, last_w) named name, loss_function5 by default"""
+    def loss_function4(output, future_price, pv_vector, last_w):
+        return -tf.reduce_mean(tf.math.log(tf.reduce_sum(output * future_price, axis=1)))
+
+    def loss_function5(output, future_price, pv_vector, last_w):
+        return -tf.reduce_mean(tf.math.log(tf.reduce_sum(output * future_price, axis=1))) + \
+               LAMBDA * tf.reduce_mean(tf.reduce_sum(-tf.math.log(1 + 1e-6 - output), axis=1))
+
+    def loss_function6(output, future_price, pv_vector, last_w):
+        return -tf.reduce_mean(tf.math.log(pv_vector))
+
+    def loss_function7(output, future_price, pv_vector, last_w):
+        return -tf.reduce_mean(tf.math.log(pv_vector)) + \
+               LAMBDA * tf.reduce_mean(tf.reduce_sum(-tf.math.log(1 + 1e-6 - output), axis=1))
+
+    def with_last_w(output, future_price, pv_vector, last_w):
+        return -tf.reduce_mean(tf.math.log(tf.reduce_sum(output * future_price, axis=1)
+                                           - tf.reduce_sum(tf.abs(output[:, 1:] - last_w) * commission_ratio, axis=1)))
+
+    loss_functions = {"loss_function4": loss_function4,
+                      "loss_function5": loss_function5,
+                      "loss_function6": loss_function6,
+                      "loss_function7": loss_function7,
+                      "loss_function8": with_last_w}
+    return loss_functions.get(name, loss_function5)
+
+
+def create_optimizer(train_config):
+    """the optimizer of training_method with the exponentially decayed learning rate of the training config"""
+    learning_rate = tf.keras.optimizers.schedules.ExponentialDecay(train_config["learning_rate"],
+                                                                   train_config["decay_steps"],
+                                                                   train_config["decay_rate"],
+                                                                   staircase=True)
+    training_method = train_config["training_method"]
+    # the epsilons of the tf.compat.v1.train optimizers
+    if training_method == 'GradientDescent':
+        return tf.keras.optimizers.SGD(learning_rate)
+    elif training_method == 'Adam':
+        return tf.keras.optimizers.Adam(learning_rate, epsilon=1e-8)
+    elif training_method == 'RMSProp':
+        return tf.keras.optimizers.RMSprop(learning_rate, rho=0.9, epsilon=1e-10)
+    else:
+        raise ValueError()
+
+
+class CashBias(tf.keras.layers.Layer):
+    """prepends the trainable score of the cash (btc) to the scores of the coins"""
+
+    def build(self, input_shape):
+        self.btc_bias = self.add_weight(name="btc_bias", shape=[1, 1], initializer="zeros")
+
+    def call(self, scores):
+        return tf.concat([tf.tile(self.btc_bias, [tf.shape(scores)[0], 1]), scores], 1)
+
+
+def build_model(feature_number, rows, columns, layers):
+    """
+    builds the EIIE network of network.CNN as a functional Keras model of inputs [x, last_w]
+    :param feature_number: the number of features of x [batch, feature_number, rows, columns]
+    :param rows: the number of coins
+    :param columns: the window size
+    :param layers: the layers config, in the schema of network.CNN
+    :return: the tf.keras.Model whose output are the portfolio weights [batch, rows + 1]
+    """
+    x = tf.keras.Input(shape=[feature_number, rows, columns], dtype=tf.float32)
+    previous_w = tf.keras.Input(shape=[rows], dtype=tf.float32)
+    # [batch, assets, window, features]
+    network = tf.transpose(x, [0, 2, 3, 1])
+    network = network / network[:, :, -1, 0, None, None]
+    for layer in layers:
+        regularizer = REGULARIZERS.get(layer.get("regularizer"))
+        kernel_regularizer = regularizer(layer["weight_decay"]) if regularizer is not None else None
+        if layer["type"] == "DenseLayer":
+            network = tf.keras.layers.Dense(int(layer["neuron_number"]),
+                                            activation=layer["activation_function"],
+                                            kernel_regularizer=kernel_regularizer)(network)
+        elif layer["type"] == "DropOut":
+            network = tf.keras.layers.Dropout(layer["keep_probability"])(network)
+        elif layer["type"] == "EIIE_Dense":
+            width = network.shape[2]
+            network = tf.keras.layers.Conv2D(int(layer["filter_number"]), (1, width), strides=(1, 1), padding="valid",
+                                             activation=layer["activation_function"],
+                                             kernel_regularizer=kernel_regularizer)(network)
+        elif layer["type"] == "ConvLayer":
+            network = tf.keras.layers.Conv2D(int(layer["filter_number"]),
+                                             [int(i) for i in layer["filter_shape"]],
+                                             strides=[int(i) for i in layer["strides"]],
+                                             padding=layer["padding"],
+                                             activation=layer["activation_function"],
+                                             kernel_regularizer=kernel_regularizer)(network)
+        elif layer["type"] == "EIIE_Output_WithW":
+            height, width, features = network.shape[1], network.shape[2], network.shape[3]
+            network = tf.reshape(network, [-1, int(height), 1, int(width * features)])
+            w = tf.reshape(previous_w, [-1, int(height), 1, 1])
+            network = tf.concat([network, w], axis=3)
+            network = tf.keras.layers.Conv2D(1, (1, 1), strides=(1, 1), padding="valid", activation="linear",
+                                             kernel_regularizer=kernel_regularizer)(network)
+            network = CashBias()(network[:, :, 0, 0])
+            network = tf.keras.layers.Softmax(axis=-1)(network)
+        # MaxPooling, AveragePooling, LocalResponseNormalization, EIIE_Output and Output_WithW are not
+        # implemented by network.CNN either
+    return tf.keras.Model(inputs=[x, previous_w], outputs=network)
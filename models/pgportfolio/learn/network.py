@@ -26,7 +26,11 @@ import tensorflow_docs.plots
 
 class NeuralNetWork:
 
-  def __init__(self, feature_number, rows, columns, layers, device):
+  def __init__(self, feature_number, rows, columns, layers, device, inputs=None):
+    """
+        :param inputs: optional function building the default input tensors in the graph of the network, a dict with
+        "x" and "last_w" (see inputpipeline.build_dataset_inputs). The placeholders then read them unless they are fed
+        """
 
     # this destroys the current TF graph session and creates a brand-new one.
     tf.keras.backend.clear_session()
@@ -76,14 +80,22 @@ class NeuralNetWork:
     #             # Memory growth must be set before GPUs have been initialized
     #             print(e)
 
-    self.input_num = tf.placeholder(tf.int32, shape=[])
-    # self.input_num = tf.keras.Input(shape=[], dtype=tf.dtypes.int32)
+    # built after the graph was reset by clear_session
+    self.inputs = inputs() if inputs is not None else None
 
-    self.input_tensor = tf.placeholder(tf.float32, shape=[None, feature_number, rows, columns])
-    #self.input_tensor = tf.keras.Input(shape=[None, feature_number, rows, columns], dtype=tf.dtypes.float32)
+    if self.inputs is None:
+      self.input_num = tf.placeholder(tf.int32, shape=[])
+      # self.input_num = tf.keras.Input(shape=[], dtype=tf.dtypes.int32)
 
-    self.previous_w = tf.placeholder(tf.float32, shape=[None, rows])
-    #self.previous_w = tf.keras.Input(shape=[None, rows], dtype=tf.dtypes.float32)
+      self.input_tensor = tf.placeholder(tf.float32, shape=[None, feature_number, rows, columns])
+      #self.input_tensor = tf.keras.Input(shape=[None, feature_number, rows, columns], dtype=tf.dtypes.float32)
+
+      self.previous_w = tf.placeholder(tf.float32, shape=[None, rows])
+      #self.previous_w = tf.keras.Input(shape=[None, rows], dtype=tf.dtypes.float32)
+    else:
+      self.input_tensor = tf.placeholder_with_default(self.inputs["x"], shape=[None, feature_number, rows, columns])
+      self.previous_w = tf.placeholder_with_default(self.inputs["last_w"], shape=[None, rows])
+      self.input_num = tf.placeholder_with_default(tf.shape(self.input_tensor)[0], shape=[])
 
     self._rows = rows
     self._columns = columns
@@ -99,8 +111,8 @@ class NeuralNetWork:
 
 class CNN(NeuralNetWork):
   # input_shape (features, rows, columns)
-  def __init__(self, feature_number, rows, columns, layers, device):
-    NeuralNetWork.__init__(self, feature_number, rows, columns, layers, device)
+  def __init__(self, feature_number, rows, columns, layers, device, inputs=None):
+    NeuralNetWork.__init__(self, feature_number, rows, columns, layers, device, inputs=inputs)
 
   def add_layer_to_dict(self, layer_type, tensor, weights=True):
 
@@ -4,21 +4,43 @@ import tensorflow.compat.v1 as tf
 import numpy as np
 from models.pgportfolio.constants import *
 import models.pgportfolio.learn.network as network
+from models.pgportfolio.learn.inputpipeline import DATASET, INPUT_PIPELINES, build_dataset_inputs
 
 class NNAgent:
-    def __init__(self, config, restore_dir=None, device="cpu"):
+    def __init__(self, config, restore_dir=None, device="cpu", data_matrices=None):
+        """
+        :param data_matrices: the DataMatrices to train on. If given and training.input_pipeline is "dataset", the
+        training batches are read from a tf.data pipeline over it, see train_from_dataset
+        """
         self.__config = config
         self.__coin_number = config["input"]["coin_number"]
+        input_pipeline = config["training"]["input_pipeline"]
+        if input_pipeline not in INPUT_PIPELINES:
+            raise ValueError("input_pipeline must be one of {}, not {}".format(INPUT_PIPELINES, input_pipeline))
+        self.__data_matrices = data_matrices if input_pipeline == DATASET else None
+        inputs = None
+        if self.__data_matrices is not None:
+            inputs = lambda: build_dataset_inputs(data_matrices,
+                                                  config["input"]["feature_number"],
+                                                  self.__coin_number,
+                                                  config["input"]["window_size"],
+                                                  depth=config["training"]["prefetch_batches"])
         self.__net = network.CNN(config["input"]["feature_number"],
                                  self.__coin_number,
                                  config["input"]["window_size"],
                                  config["layers"],
-                                 device=device)
+                                 device=device,
+                                 inputs=inputs)
         self.__global_step = tf.Variable(0, trainable=False)
         self.__train_operation = None
-        self.__y = tf.placeholder(tf.float32, shape=[None,
-                                                     self.__config["input"]["feature_number"],
-                                                     self.__coin_number])
+        if self.__net.inputs is None:
+            self.__y = tf.placeholder(tf.float32, shape=[None,
+                                                         self.__config["input"]["feature_number"],
+                                                         self.__coin_number])
+        else:
+            self.__y = tf.placeholder_with_default(self.__net.inputs["y"], shape=[None,
+                                                                                  self.__config["input"]["feature_number"],
+                                                                                  self.__coin_number])
         self.__future_price = tf.concat([tf.ones([self.__net.input_num, 1]),
                                        self.__y[:, 0, :]], 1)
         self.__future_omega = (self.__future_price * self.__net.output) /\
@@ -44,6 +66,8 @@ class NNAgent:
             self.__saver.restore(self.__net.session, restore_dir)
         else:
             self.__net.session.run(tf.compat.v1.global_variables_initializer())
+        if self.__net.inputs is not None:
+            self.__net.session.run(self.__net.inputs["iterator"].initializer)
 
     @property
     def session(self):
@@ -81,6 +105,11 @@ class NNAgent:
     def loss(self):
         return self.__loss
 
+    @property
+    def has_input_pipeline(self):
+        """True if the training batches are read from a tf.data pipeline, see train_from_dataset"""
+        return self.__net.inputs is not None
+
     @property
     def layers_dict(self):
         return self.__net.layers_dict
@@ -142,20 +171,31 @@ class NNAgent:
             raise ValueError()
         return train_step
 
-    def train(self, x, y, last_w, setw):
+    def train(self, x, y, last_w, setw, check_nan=True):
         #tflearn.is_training(True, self.__net.session)
         # print('---------------------------------------------------------------')
         # print(f'eager mode: {tf.executing_eagerly()}')
         # print('---------------------------------------------------------------')
-        self.evaluate_tensors(x, y, last_w, setw, [self.__train_operation])
+        self.evaluate_tensors(x, y, last_w, setw, [self.__train_operation], check_nan=check_nan)
 
-    def evaluate_tensors(self, x, y, last_w, setw, tensors):
+    def train_from_dataset(self):
+        """
+        runs a training step on the next batch of the tf.data pipeline, nothing is fed, and writes the output weights
+        of the batch back to the PVM of the data matrices
+        """
+        indexs, output = self.__net.session.run([self.__net.inputs["indexs"], self.__net.output, self.__train_operation])[:2]
+        assert not np.any(np.isnan(output)), "the output is {}".format(output)
+        self.__data_matrices.write_w(indexs, output[:, 1:])
+
+    def evaluate_tensors(self, x, y, last_w, setw, tensors, check_nan=True):
         """
         :param x:
         :param y:
         :param last_w:
         :param setw: a function, pass the output w to it to fill the PVM
         :param tensors:
+        :param check_nan: if False x and y are not checked for nan, e.g. their data matrices were checked once with
+        DataMatrices.check_nan
         :return:
         """
         tensors = list(tensors)
@@ -165,8 +205,9 @@ class NNAgent:
         # print('------------------')
         # print(y)
 
-        assert not np.any(np.isnan(x))
-        assert not np.any(np.isnan(y))
+        if check_nan:
+            assert not np.any(np.isnan(x))
+            assert not np.any(np.isnan(y))
         assert not np.any(np.isnan(last_w)), "the last_w is {}".format(last_w)
         results = self.__net.session.run(tensors,
                                          feed_dict={self.__net.input_tensor: x,
@@ -180,6 +221,15 @@ class NNAgent:
     def save_model(self, path):
         self.__saver.save(self.__net.session, path)
 
+    def snapshot_variables(self):
+        """returns the values of the variables of the graph, which restore_variables loads back without any disk I/O"""
+        variables = self.__net.session.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+        return list(zip(variables, self.__net.session.run(variables)))
+
+    def restore_variables(self, snapshot):
+        for variable, value in snapshot:
+            variable.load(value, self.__net.session)
+
     # consumption vector (on each periods)
     def __pure_pc(self):
         c = self.__commission_ratio
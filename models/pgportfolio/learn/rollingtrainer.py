@@ -12,10 +12,10 @@ training_logger = get_custom_training_logger(__name__)
 
 class RollingTrainer(TraderTrainer):
 
-  def __init__(self, config, restore_dir=None, save_path=None, agent=None, device="cpu"):
+  def __init__(self, config, restore_dir=None, save_path=None, agent=None, device="cpu", global_data=None):
     config["training"]["buffer_biased"] = config["trading"]["buffer_biased"]
     config["training"]["learning_rate"] = config["trading"]["learning_rate"]
-    TraderTrainer.__init__(self, config, restore_dir=restore_dir, save_path=save_path, agent=agent, device=device)
+    TraderTrainer.__init__(self, config, restore_dir=restore_dir, save_path=save_path, agent=agent, device=device, global_data=global_data)
 
   @property
   def agent(self):
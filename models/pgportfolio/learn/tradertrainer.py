@@ -22,8 +22,8 @@ import numpy as np
 import pandas as pd
 from common.db import MariaDB
 import tensorflow.compat.v1 as tf
-from models.pgportfolio.learn.nnagent import NNAgent
 from models.pgportfolio.marketdata.datamatrices import DataMatrices
+from models.pgportfolio.marketdata.prefetch import BatchPrefetcher
 
 from common.custom_logger2 import get_custom_logger, get_custom_training_logger
 
@@ -47,24 +47,58 @@ Result = collections.namedtuple(
 )
 
 
+# the agents selected by config["agent_type"], imported lazily as nnagent disables the TF2 behavior of the process
+NN_AGENT = "NNAgent"
+KERAS_AGENT = "KerasAgent"
+AGENT_TYPES = (NN_AGENT, KERAS_AGENT)
+
+
+def create_agent(config, restore_dir=None, device="cpu", data_matrices=None):
+  """
+
+    Creates the agent of config["agent_type"]: NNAgent, the tf.compat.v1 graph of network.CNN, or KerasAgent, the
+    same network as a Keras model trained by a tf.function step.
+
+    Args:
+        config (dict): the config dictionary
+        restore_dir (str, optional): the checkpoint to restore. Defaults to None.
+        device (str, optional): "cpu" or "gpu". Defaults to "cpu".
+        data_matrices (DataMatrices, optional): the data matrices of the tf.data input pipeline of NNAgent. Defaults to None.
+
+    Returns:
+        the agent
+    """
+  agent_type = config["agent_type"]
+  if agent_type == NN_AGENT:
+    from models.pgportfolio.learn.nnagent import NNAgent
+    return NNAgent(config, restore_dir, device, data_matrices=data_matrices)
+  elif agent_type == KERAS_AGENT:
+    from models.pgportfolio.learn.kerasagent import KerasAgent
+    return KerasAgent(config, restore_dir, device)
+  raise ValueError("agent_type must be one of {}, not {}".format(AGENT_TYPES, agent_type))
+
+
 class TraderTrainer:
 
-  def __init__(self, config, fake_data=False, restore_dir=None, save_path=None, device="cpu", agent=None, logging_q: Queue = None):
+  def __init__(self, config, fake_data=False, restore_dir=None, save_path=None, device="cpu", agent=None, logging_q: Queue = None, global_data=None, data_matrices=None):
     """
         :param config: config dictionary
-        :param fake_data: if True will use data generated randomly
+        :param fake_data: if True will use data generated randomly, otherwise the input.fake_data of config is kept
         :param restore_dir: path to the model trained before
         :param save_path: path to save the model
         :param device: the device used to train the network
         :param agent: the nnagent object. If this is provided, the trainer will not create a new agent by itself. Therefore the restore_dir will not affect anything.
         :param logging_q: the threadsafe queue used to push logging message
+        :param global_data: the global data shared by the parent process, see DataMatrices.share_global_data
+        :param data_matrices: the DataMatrices to train on, e.g. the ones of an ensemble replica. If this is provided, the data is not loaded again and global_data will not affect anything.
         """
 
     # set up the logger
-    qh = logging.handlers.QueueHandler(logging_q)
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(qh)
+    if logging_q is not None:
+      qh = logging.handlers.QueueHandler(logging_q)
+      root_logger = logging.getLogger()
+      root_logger.setLevel(logging.DEBUG)
+      root_logger.addHandler(qh)
 
     training_logger.info("TraderTrainer __init__()")
     self.config = config
@@ -78,9 +112,25 @@ class TraderTrainer:
     self.__coin_number = self.input_config["coin_number"]
     self.__batch_size = self.train_config["batch_size"]
     self.__snap_shot = self.train_config["snap_shot"]
-    config["input"]["fake_data"] = fake_data
-
-    self._matrix = DataMatrices.create_from_config(config)
+    # the training stops after this many evaluations without a better test portfolio value, 0 never stops
+    self.__patience = self.train_config["early_stopping_patience"]
+    self.__evaluations_without_improvement = 0
+    # the variables of the best model if snap_shot, kept in memory and written once the training is over
+    self.__best_snapshot = None
+    # in save memory mode the sets are evaluated by chunks of windows, see _evaluate_by_chunks
+    self.__save_memory_mode = self.input_config["save_memory_mode"]
+    self.__evaluation_chunk_size = self.train_config["evaluation_chunk_size"]
+    if fake_data:
+      config["input"]["fake_data"] = True
+
+    if data_matrices is not None:
+      self._matrix = data_matrices
+    else:
+      self._matrix = DataMatrices.create_from_config(config, global_data=global_data)
+      # the samples are not checked for nan one by one, see NNAgent.evaluate_tensors
+      self._matrix.check_nan()
+    # set by train_net while it runs, see BatchPrefetcher
+    self._prefetcher = None
 
     self.test_set = self._matrix.get_test_set()
     if not config["training"]["fast_train"]:
@@ -95,9 +145,9 @@ class TraderTrainer:
       if device == "cpu":
         os.environ["CUDA_VISIBLE_DEVICES"] = ""
         with tf.device("/cpu:0"):
-          self._agent = NNAgent(config, restore_dir, device)
+          self._agent = create_agent(config, restore_dir, device, data_matrices=self._matrix)
       else:
-        self._agent = NNAgent(config, restore_dir, device)
+        self._agent = create_agent(config, restore_dir, device, data_matrices=self._matrix)
 
   def _evaluate(self, set_name, *tensors):
     if set_name == "test":
@@ -106,28 +156,63 @@ class TraderTrainer:
       feed = self.training_set
     else:
       raise ValueError()
-    result = self._agent.evaluate_tensors(feed["X"], feed["y"], last_w=feed["last_w"], setw=feed["setw"], tensors=tensors)
+    if self.__save_memory_mode:
+      return self._evaluate_by_chunks(feed, tensors)
+    result = self._agent.evaluate_tensors(feed["X"], feed["y"], last_w=feed["last_w"], setw=feed["setw"], tensors=tensors, check_nan=False)
     return result
 
+  def _evaluate_by_chunks(self, feed, tensors):
+    """
+
+        Evaluates the agent over a set one chunk of windows at a time, so that the windows of the whole set are never
+        fed at once, and computes the requested metrics from the portfolio values and weights of all the chunks.
+
+        Supported tensors are portfolio_value, log_mean, log_mean_free, pv_vector, portfolio_weights and loss, the
+        loss being the mean of the chunk losses weighted by their number of samples. Any other tensor, e.g. the
+        tensorboard summary, evaluates to None.
+
+        """
+    agent = self._agent
+    pv_vectors, weights, free_pvs, loss_sum = [], [], [], 0.0
+    for overlap, batch in self._matrix.iter_samples(feed["indexs"], self.__evaluation_chunk_size, last_w=feed["last_w"]):
+      pv_vector, loss, output = agent.evaluate_tensors(batch["X"], batch["y"], last_w=batch["last_w"], setw=batch["setw"],
+                                                       tensors=[agent.pv_vector, agent.loss, agent.portfolio_weights], check_nan=False)
+      future_price = np.concatenate((np.ones((output.shape[0], 1), dtype=output.dtype), batch["y"][:, 0, :]), axis=1)
+      # the first row of a chunk with overlap belongs to the previous chunk, it only provides the previous weights
+      pv_vectors.append(pv_vector[overlap:])
+      weights.append(output[overlap:])
+      free_pvs.append(np.sum(output * future_price, axis=1)[overlap:])
+      loss_sum += loss * (output.shape[0] - overlap)
+    pv_vector = np.concatenate(pv_vectors)
+    metrics = [
+        (agent.portfolio_value, np.prod(pv_vector)),
+        (agent.log_mean, np.mean(np.log(pv_vector))),
+        (agent.log_mean_free, np.mean(np.log(np.concatenate(free_pvs)))),
+        (agent.pv_vector, pv_vector),
+        (agent.portfolio_weights, np.concatenate(weights)),
+        (agent.loss, loss_sum / len(pv_vector)),
+    ]
+    return [next((value for metric, value in metrics if metric is tensor), None) for tensor in tensors]
+
   @staticmethod
   def calculate_upperbound(y):
-    array = np.maximum.reduce(y[:, 0, :], 1)
-    total = 1.0
-    for i in array:
-      total = total * i
-    return total
+    # the product of the float32 best returns is accumulated in float64
+    return float(np.prod(np.max(y[:, 0, :], axis=1), dtype=np.float64))
 
   def log_between_steps(self, step):
+    """evaluates the agent on the test set, returns True if the training should stop early"""
     fast_train = self.train_config["fast_train"]
     # tflearn.is_training(False, self._agent.session)
 
     summary, v_pv, v_log_mean, v_loss, log_mean_free, weights = self._evaluate("test", self.summary, self._agent.portfolio_value, self._agent.log_mean,
                                                                                self._agent.loss, self._agent.log_mean_free, self._agent.portfolio_weights)
-    self.test_writer.add_summary(summary, step)
+    if summary is not None:
+      self.test_writer.add_summary(summary, step)
 
     if not fast_train:
       summary, loss_value = self._evaluate("training", self.summary, self._agent.loss)
-      self.train_writer.add_summary(summary, step)
+      if summary is not None:
+        self.train_writer.add_summary(summary, step)
 
     # print 'ouput is %s' % out
     logger.info("=" * 50)
@@ -145,21 +230,23 @@ class TraderTrainer:
     #             "loss_value is %3f\nlog mean without commission fee is %3f\n" % (v_pv, v_log_mean, v_loss, log_mean_free))
     logger.info("=" * 50)
 
-    if not self.__snap_shot:
-      self._agent.save_model(self.save_path)
-    elif v_pv > self.best_metric:
+    if v_pv > self.best_metric:
       self.best_metric = v_pv
+      self.__evaluations_without_improvement = 0
       logger.info(f"!!!! Got better model at [{step}] steps, whose test portfolio value is [{v_pv}] !!!!")
-      if self.save_path:
-        self._agent.save_model(self.save_path)
+      if self.__snap_shot:
+        self.__best_snapshot = self._agent.snapshot_variables()
+    else:
+      self.__evaluations_without_improvement += 1
     self.check_abnormal(v_pv, weights)
+    return self.__patience > 0 and self.__evaluations_without_improvement >= self.__patience
 
   def check_abnormal(self, portfolio_value, weigths):
     if portfolio_value == 1.0:
       logger.info("average portfolio weights {}".format(weigths.mean(axis=0)))
 
   def next_batch(self):
-    batch = self._matrix.next_batch()
+    batch = self._prefetcher.get() if self._prefetcher is not None else self._matrix.next_batch()
     batch_input = batch["X"]
     batch_y = batch["y"]
     batch_last_w = batch["last_w"]
@@ -195,7 +282,9 @@ class TraderTrainer:
         :return: the result named tuple
         """
     self.__print_upperbound()
-    if log_file_dir:
+    # the summaries are tensors of the graph of NNAgent
+    self.summary = None
+    if log_file_dir and self.config["agent_type"] == NN_AGENT:
       if self.device == "cpu":
         with tf.device("/cpu:0"):
           self.__init_tensor_board(log_file_dir)
@@ -206,25 +295,41 @@ class TraderTrainer:
     total_data_time = 0
     total_training_time = 0
 
-    # loop though number of steps (not epochs)
-    for i in range(self.train_config["steps"]):
-      step_start = time.time()
-      x, y, last_w, setw = self.next_batch()
-      finish_data = time.time()
-      total_data_time += finish_data - step_start
-      self._agent.train(x, y, last_w=last_w, setw=setw)
-      total_training_time += time.time() - finish_data
-      if i % 1000 == 0 and log_file_dir:
-        logger.info("average time for data accessing is %s" % (total_data_time / 1000))
-        logger.info("average time for training is %s" % (total_training_time / 1000))
-        total_training_time = 0
-        total_data_time = 0
-        self.log_between_steps(i)
-
+    # the tf.data pipeline of the agent prefetches by itself
+    if self.train_config["prefetch_batches"] > 0 and not self._agent.has_input_pipeline:
+      self._prefetcher = BatchPrefetcher(self._matrix, depth=self.train_config["prefetch_batches"], mode=self.train_config["prefetch_mode"])
+    try:
+      # loop though number of steps (not epochs)
+      for i in range(self.train_config["steps"]):
+        step_start = time.time()
+        if self._agent.has_input_pipeline:
+          finish_data = step_start
+          self._agent.train_from_dataset()
+        else:
+          x, y, last_w, setw = self.next_batch()
+          finish_data = time.time()
+          total_data_time += finish_data - step_start
+          self._agent.train(x, y, last_w=last_w, setw=setw, check_nan=False)
+        total_training_time += time.time() - finish_data
+        if i % 1000 == 0 and log_file_dir:
+          logger.info("average time for data accessing is %s" % (total_data_time / 1000))
+          logger.info("average time for training is %s" % (total_training_time / 1000))
+          total_training_time = 0
+          total_data_time = 0
+          if self.log_between_steps(i):
+            logger.info(f"stopping early at [{i}] steps, the test portfolio value did not improve for {self.__patience} evaluations")
+            break
+    finally:
+      if self._prefetcher is not None:
+        self._prefetcher.close()
+        self._prefetcher = None
+
+    # the best model is restored in the current session and saved once
+    if self.__best_snapshot is not None:
+      self._agent.restore_variables(self.__best_snapshot)
+      self.__best_snapshot = None
     if self.save_path:
-      self._agent.recycle()
-      best_agent = NNAgent(self.config, restore_dir=self.save_path)
-      self._agent = best_agent
+      self._agent.save_model(self.save_path)
 
     pv, log_mean = self._evaluate("test", self._agent.portfolio_value, self._agent.log_mean)
     logger.warning("the portfolio value train No.%s is %s log_mean is %s,"
@@ -242,20 +347,22 @@ class TraderTrainer:
     return
 
   def __log_and_save_result(self, index, time):
+    result = self.evaluate_result(index, time)
+    self.save_results([result])
+    return result
+
+  def evaluate_result(self, index, training_time) -> Result:
+    """evaluates the agent on the test set and backtests it, returns the Result of the train_package folder index"""
     from models.pgportfolio.trade import backtest
 
-    dataframe = None
-    print(os.getcwd())
-    csv_dir = os.path.join("models", "train_package", "train_summary.csv")
-    ##csv_dir = "./train_package/train_summary.csv"
     # tflearn.is_training(False, self._agent.session)
     v_pv, v_log_mean, benefit_array, v_log_mean_free = self._evaluate("test", self._agent.portfolio_value, self._agent.log_mean, self._agent.pv_vector,
                                                                       self._agent.log_mean_free)
 
-    backtest = backtest.BackTest(self.config.copy(), net_dir=None, agent=self._agent)
+    backtest = backtest.BackTest(self.config.copy(), net_dir=None, agent=self._agent, global_data=self._matrix.global_data)
 
     backtest.start_trading()
-    result = Result(
+    return Result(
         test_pv=[v_pv],
         test_log_mean=[v_log_mean],
         test_log_mean_free=[v_log_mean_free],
@@ -265,20 +372,23 @@ class TraderTrainer:
         backtest_test_pv=[backtest.test_pv],
         backtest_test_history=["".join(str(e) + ", " for e in backtest.test_pc_vector)],
         backtest_test_log_mean=[np.mean(np.log(backtest.test_pc_vector))],
-        training_time=int(time),
+        training_time=int(training_time),
     )
-    new_data_frame = pd.DataFrame(result._asdict()).set_index("net_dir")
+
+  def save_results(self, results: list) -> None:
+    """saves Results to the database and the saved_models, and appends them to train_summary.csv unless they all come from folder 0"""
+    csv_dir = os.path.join("models", "train_package", "train_summary.csv")
+    ##csv_dir = "./train_package/train_summary.csv"
+    new_data_frame = pd.concat([pd.DataFrame(result._asdict()) for result in results]).set_index("net_dir")
 
     self._save_results_to_db(new_data_frame)
 
     if os.path.isfile(csv_dir):
-      dataframe = pd.read_csv(csv_dir).set_index("net_dir")
-      dataframe = dataframe.append(new_data_frame)
+      dataframe = pd.concat([pd.read_csv(csv_dir).set_index("net_dir"), new_data_frame])
     else:
       dataframe = new_data_frame
-    if int(index) > 0:
+    if any(int(result.net_dir[0]) > 0 for result in results):
       dataframe.to_csv(csv_dir)
-    return result
 
   def _save_results_to_db(self, results_df: pd.DataFrame) -> None:
     """save the results of this training session
@@ -1,10 +1,13 @@
 from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
-from re import L
-from models.pgportfolio.marketdata.poloniex import Poloniex
+from models.pgportfolio.marketdata.poloniex import Poloniex, DEFAULT_REQUESTS_PER_SECOND
+from models.pgportfolio.marketdata.provider import DataProvider, POLONIEX
 from models.pgportfolio.tools.data import get_chart_until_success
+import os
+import time
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from tabulate import tabulate
 
@@ -16,6 +19,12 @@ from common.custom_logger2 import global_training_queue
 logger = get_custom_logger(__name__)
 training_logger = get_custom_training_logger(__name__)
 
+RANKING_CACHE_DIR = os.path.join(os.path.dirname(os.path.normpath(DATABASE_DIR)), "coinlist_cache")
+# seconds a market ranking is reused for
+DEFAULT_RANKING_TTL = HOUR
+# number of pair volumes fetched at the same time, the provider rate limit still applies
+DEFAULT_VOLUME_WORKERS = 8
+
 
 class CoinList(object):
   """
@@ -23,55 +32,42 @@ class CoinList(object):
     This class maintains list of coins/volumnes/prices from provider.
     From this we can get list of top N coins by volume for the given date range (from volume f)
 
-    in the __init__ method it gets list of market volumn and ticker information from provider and then extraces relavent data and stores in lists
+    in the __init__ method it gets list of market volumn and ticker information from provider and then extraces relavent data and stores in lists.
+    The daily volumes of the pairs are fetched concurrently and the resulting ranking is cached on disk for
+    ranking_ttl seconds, keyed on (hour of end, volume_average_days, volume_forward). Rankings of local
+    providers are cheap and never cached.
 
     Args:
         object ([type]): [description]
     """
 
-  def __init__(self, end, volume_average_days=1, volume_forward=0):
-    self._polo = Poloniex()
-    # connect the internet to accees volumes
-    vol = self._polo.marketVolume()
-    ticker = self._polo.marketTicker()
-    pairs = []
-    coins = []
-    volumes = []
-    prices = []
+  def __init__(self,
+               end,
+               volume_average_days=1,
+               volume_forward=0,
+               requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+               max_workers=DEFAULT_VOLUME_WORKERS,
+               ranking_ttl=DEFAULT_RANKING_TTL,
+               provider: DataProvider = None):
+    self._provider = provider if provider is not None else Poloniex(requests_per_second=requests_per_second)
+    if self._provider.name != POLONIEX:
+      ranking_ttl = 0
 
     logger.info('Selecting the Coin Data to get top N coins')
     logger.info("select coin online from %s to %s" % (datetime.fromtimestamp(end - (DAY * volume_average_days) - volume_forward).strftime('%Y-%m-%d %H:%M'),
                                                       datetime.fromtimestamp(end - volume_forward).strftime('%Y-%m-%d %H:%M')))
-    for k, v in vol.items():
-      if k.startswith("BTC_") or k.endswith("_BTC"):
-        pairs.append(k)
-        logger.info(f'Getting volumn/price data for: {k}')
-        last_price: float = 0
-        volume: int = 0
-        for c, val in v.items():
-          if c != 'BTC':
-            if k.endswith('_BTC'):
-              coins.append('reversed_' + c)
-              last_price = 1.0 / float(ticker[k]['last'])
-              prices.append(last_price)
-            else:
-              coins.append(c)
-              last_price = float(ticker[k]['last'])
-              prices.append(last_price)
-          else:
-            volume: int = self.__get_total_volume(pair=k, global_end=end, days=volume_average_days, forward=volume_forward)
-            volumes.append(volume)
-          if last_price != 0:
-            logger.info(f" >>>  coin: {c}, pair: {k}, vol: {volume}, price: {last_price}")
 
-    self._df = pd.DataFrame({'coin': coins, 'pair': pairs, 'volume': volumes, 'price': prices})
+    cache_path = self.__ranking_cache_path(end, volume_average_days, volume_forward)
+    self._df = self.__load_ranking(cache_path, ranking_ttl)
+    if self._df is None:
+      self._df = self.__rank_market(end, volume_average_days, volume_forward, max_workers)
+      if ranking_ttl > 0:
+        self.__store_ranking(cache_path, self._df)
 
-    self._df = self._df.set_index('coin')
     logger.info('*' * 70)
     logger.info('*    COINLIST: Vol info FOR LAST 24 hours  ')
     logger.info('*' * 70)
 
-    self._df = self._df.sort_values(by=['volume'], ascending=[False])
     counter: int = 1
     for coin, row in self._df.iterrows():
       vol: float = round(float(row['volume']), 4)
@@ -81,20 +77,81 @@ class CoinList(object):
       logger.info(log_str)
       counter += 1
 
+  def __rank_market(self, end, volume_average_days, volume_forward, max_workers) -> pd.DataFrame:
+    """gets the market volume and ticker, then sums the daily volume of every BTC pair concurrently"""
+    start_timeit = time.time()
+    # connect the internet to accees volumes
+    vol = self._provider.marketVolume()
+    ticker = self._provider.marketTicker()
+    pairs = []
+    coins = []
+    prices = []
+
+    for k, v in vol.items():
+      if k.startswith("BTC_") or k.endswith("_BTC"):
+        pairs.append(k)
+        for c, val in v.items():
+          if c != 'BTC':
+            if k.endswith('_BTC'):
+              coins.append('reversed_' + c)
+              prices.append(1.0 / float(ticker[k]['last']))
+            else:
+              coins.append(c)
+              prices.append(float(ticker[k]['last']))
+
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+      volumes = list(executor.map(lambda pair: self.__get_total_volume(pair=pair, global_end=end, days=volume_average_days, forward=volume_forward), pairs))
+    logger.info(f"ranked {len(pairs)} pairs in {time.time() - start_timeit:.2f} seconds")
+
+    df = pd.DataFrame({'coin': coins, 'pair': pairs, 'volume': volumes, 'price': prices})
+    df = df.set_index('coin')
+    return df.sort_values(by=['volume'], ascending=[False])
+
+  @staticmethod
+  def __ranking_cache_path(end, volume_average_days, volume_forward) -> str:
+    # rankings are reused for every end within the same hour
+    key = f"{int(end) // HOUR}_{volume_average_days}_{int(volume_forward)}"
+    return os.path.join(RANKING_CACHE_DIR, f"ranking_{key}.pkl")
+
+  @staticmethod
+  def __load_ranking(cache_path: str, ranking_ttl: float):
+    if ranking_ttl <= 0 or not os.path.isfile(cache_path):
+      return None
+    if time.time() - os.path.getmtime(cache_path) > ranking_ttl:
+      return None
+    try:
+      df = pd.read_pickle(cache_path)
+    except Exception as e:
+      logger.warning(f"ignoring unreadable coin ranking cache {cache_path}: {e}")
+      return None
+    logger.info(f"using cached coin ranking {cache_path}")
+    return df
+
+  @staticmethod
+  def __store_ranking(cache_path: str, df: pd.DataFrame) -> None:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, cache_path)
+
   @property
   def allActiveCoins(self):
     return self._df
 
   @property
   def allCoins(self):
-    return self._polo.marketStatus().keys()
+    return sorted({currency for pair in self._provider.activePairs() for currency in pair.split('_')})
+
+  @property
+  def provider(self) -> DataProvider:
+    return self._provider
 
   @property
   def polo(self):
-    return self._polo
+    return self._provider
 
   def get_chart_until_success(self, pair, start, period, end):
-    return get_chart_until_success(self._polo, pair, start, period, end)
+    return get_chart_until_success(self._provider, pair, start, period, end)
 
   # get several days volume
   def __get_total_volume(self, pair, global_end, days, forward):
@@ -1,13 +1,22 @@
 from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import division
+import os
+import tempfile
 import models.pgportfolio.marketdata.globaldatamatrix as gdm
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
 from models.pgportfolio.tools.configprocess import parse_time
-from models.pgportfolio.tools.data import get_volume_forward, get_type_list
+from models.pgportfolio.tools.data import get_volume_forward, get_type_list, array_to_panel, array_fillna
 import models.pgportfolio.marketdata.replaybuffer as rb
+from models.pgportfolio.marketdata.poloniex import DEFAULT_REQUESTS_PER_SECOND
+from models.pgportfolio.marketdata.panelcache import PanelCache, DEFAULT_CACHE_SIZE_MB
+from models.pgportfolio.marketdata.provider import create_provider
+from models.pgportfolio.marketdata import synthetic
+from models.pgportfolio.tools.sharedarray import SharedArray
+from models.pgportfolio.constants import DATABASE_DIR
 
 from common.custom_logger2 import get_custom_logger, get_custom_training_logger
 
@@ -15,6 +24,14 @@ logger = get_custom_logger(__name__)
 training_logger = get_custom_training_logger(__name__)
 
 MIN_NUM_PERIOD = 3
+# where the global data is memory mapped in save_memory_mode
+MEMMAP_DIR = os.path.join(os.path.dirname(os.path.normpath(DATABASE_DIR)), "memmap")
+# growth of the time axis capacity when the data is extended, amortizes the copies
+GROWTH_FACTOR = 1.5
+# dtype policy: the global data is stored as one of STORAGE_DTYPES, while the batches, the sets and the PVM which are
+# fed to the network are COMPUTE_DTYPE, the dtype of its placeholders. Narrower storage dtypes need save_memory_mode
+COMPUTE_DTYPE = np.float32
+STORAGE_DTYPES = ("float32", "float16")
 
 
 class DataMatrices:
@@ -33,7 +50,17 @@ class DataMatrices:
                test_portion=0.15,
                portion_reversed=False,
                online=False,
-               is_permed=False):
+               is_permed=False,
+               download_workers=gdm.DEFAULT_DOWNLOAD_WORKERS,
+               requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+               panel_cache_size_mb=DEFAULT_CACHE_SIZE_MB,
+               data_dir=None,
+               share_pvm=False,
+               global_data=None,
+               save_memory_mode=False,
+               storage_dtype="float32",
+               fake_data=False,
+               fake_seed=0):
     """
 
         This class stores info regarding the input data matricies to be used by the algo.
@@ -53,7 +80,31 @@ class DataMatrices:
         :param test_portion: portion of test set
         :param portion_reversed: if False, the order to sets are [train, validation, test]
         else the order is [test, validation, train]
+        :param download_workers: number of coins/chunks of history downloaded concurrently
+        :param requests_per_second: rate limit of the requests sent to the data provider
+        :param panel_cache_size_mb: size limit of the on-disk cache of global data matrices, 0 disables the cache
+        :param data_provider: POLONIEX, or FILE to replay the candle archives of data_dir (see create_provider)
+        :param data_dir: the directory of the candle archives of the FILE data provider
+        :param share_pvm: if True the portfolio vector memory is allocated in shared memory, see pvm_descriptor
+        :param global_data: the global data published by another process with share_global_data, or the global_data
+        property of another DataMatrices of this process. If given it is
+        attached read only instead of being loaded from the DB, the coins are the published ones
+        :param save_memory_mode: if True the global data is kept in a memory mapped file of storage_dtype, so that
+        it is paged in on demand instead of being held in RAM. The history manager writes it there one coin at a time.
+        Use iter_samples to evaluate over it in chunks. The global data shared by another process is read from its
+        shared memory instead, see global_data
+        :param storage_dtype: one of STORAGE_DTYPES, the dtype the global data is stored in. The samples are
+        converted to COMPUTE_DTYPE when they are packed, float16 halves the memory of the global data. A storage
+        dtype other than COMPUTE_DTYPE requires save_memory_mode, whose sets are converted chunk by chunk by
+        iter_samples, as the whole sets would otherwise be converted at once
+        :param fake_data: if True the global data is a synthetic market of coin_filter coins over the time axis of
+        start, end and period (see synthetic.generate_global_array), no database nor data provider is used
+        :param fake_seed: the seed of the synthetic market
         """
+    if storage_dtype not in STORAGE_DTYPES:
+      raise ValueError("storage_dtype must be one of {}, not {}".format(STORAGE_DTYPES, storage_dtype))
+    if np.dtype(storage_dtype) != COMPUTE_DTYPE and not save_memory_mode:
+      raise ValueError(f"storage_dtype {storage_dtype} requires save_memory_mode")
     start = int(start)
     self.__start = start
     self.__end = int(end)
@@ -66,34 +117,75 @@ class DataMatrices:
     type_list = get_type_list(feature_number)
     self.__features = type_list
     self.feature_number = feature_number
-    volume_forward = get_volume_forward(self.__end - start, test_portion, portion_reversed)
-    self.__history_manager = gdm.HistoryManager(coin_number=coin_filter,
-                                                end=self.__end,
-                                                volume_average_days=volume_average_days,
-                                                volume_forward=volume_forward,
-                                                online=online)
-    if data_provider.upper() == "POLONIEX" or len(data_provider) == 0:
-      self.__global_data = self.__history_manager.get_global_panel(start, self.__end, period=period, features=type_list)
-      logger.info(self.__global_data.shape)
-      logger.info(f'num_features = {self.__global_data.shape[1]}')
-      # convenience variable to hold global data as array
-      global_data_as_array = self.__global_data.values.reshape(self.__coin_no, -1, self.__global_data.shape[1])
-      global_data_as_array = global_data_as_array.transpose(2, 0, 1)
-      self.__global_data_array = np.array(global_data_as_array)
+    if fake_data and global_data is None:
+      self.__history_manager = None
+      self.__shared_global_data = None
+      self.__coins = synthetic.fake_coins(coin_filter)
+      self.__global_data_array = synthetic.generate_global_array(coin_filter,
+                                                                 len(gdm.HistoryManager.get_time_axis(start, self.__end, period)),
+                                                                 features=type_list,
+                                                                 period=period,
+                                                                 seed=fake_seed)
+    elif global_data is None:
+      volume_forward = get_volume_forward(self.__end - start, test_portion, portion_reversed)
+      provider = create_provider(data_provider, data_dir, requests_per_second=requests_per_second)
+      self.__history_manager = gdm.HistoryManager(coin_number=coin_filter,
+                                                  end=self.__end,
+                                                  volume_average_days=volume_average_days,
+                                                  volume_forward=volume_forward,
+                                                  online=online,
+                                                  max_workers=download_workers,
+                                                  requests_per_second=requests_per_second,
+                                                  panel_cache=PanelCache(max_size_mb=panel_cache_size_mb) if panel_cache_size_mb > 0 else None,
+                                                  provider=provider)
+      self.__shared_global_data = None
+      # in save_memory_mode the history manager writes the global data into the memory map one coin at a time
+      out = None
+      if save_memory_mode:
+        shape = (len(type_list), coin_filter, len(gdm.HistoryManager.get_time_axis(start, self.__end, period)))
+        out = self.__create_memmap(shape, np.dtype(storage_dtype))
+      self.__global_data_array = self.__history_manager.get_global_data_matrix(start, self.__end, period=period, features=type_list, out=out)
+      self.__coins = list(self.__history_manager.coins)
     else:
-      raise ValueError("market {} is not valid".format(data_provider))
+      self.__history_manager = None
+      self.__coins = list(global_data["coins"])
+      if isinstance(global_data["array"], np.ndarray):
+        # the global data of another DataMatrices of this process, see the global_data property
+        self.__shared_global_data = None
+        self.__global_data_array = global_data["array"]
+      else:
+        self.__shared_global_data = SharedArray.attach(*global_data["array"], readonly=True)
+        self.__global_data_array = self.__shared_global_data.array
+        logger.info(f'attached the global data matrix shared as {self.__shared_global_data.name}')
+      if self.__global_data_array.dtype != COMPUTE_DTYPE and not save_memory_mode:
+        raise ValueError(f"the global data is shared as {self.__global_data_array.dtype}, which requires save_memory_mode")
+      if save_memory_mode and self.__shared_global_data is not None:
+        # the shared memory is a single copy of the global data for all the processes, it is used as is
+        logger.warning("save_memory_mode is ignored for the global data shared by another process, it is read from the shared "
+                       f"memory in its {self.__global_data_array.dtype} storage dtype instead of a memory mapped file")
+    self.__save_memory_mode = save_memory_mode
+    if save_memory_mode and global_data is None:
+      self.__global_data_array = self.__to_memmap(self.__global_data_array, np.dtype(storage_dtype))
+    elif global_data is None:
+      self.__global_data_array = self.__to_storage(self.__global_data_array, np.dtype(storage_dtype))
+    logger.info(f'global data matrix [feature, coin, time]: {self.__global_data_array.shape} {self.__global_data_array.dtype}')
     self.__period_length = period
+    self.__time_axis = gdm.HistoryManager.get_time_axis(start, self.__end, period)
+    # set by extend, the global data, PVM and time axis are then views of these buffers with spare capacity
+    self.__buffers = None
     # portfolio vector memory, [time, assets]
-    logger.info(f'Data Frame: level(0) = {self.__global_data.index.get_level_values(0).unique()}')
-    self.__PVM = pd.DataFrame(index=self.__global_data.index.get_level_values(1), columns=self.__global_data.index.get_level_values(0).unique())
-    self.__PVM = self.__PVM.fillna(1.0 / self.__coin_no)
+    pvm_shape = (len(self.__time_axis), len(self.__coins))
+    self.__shared_pvm = SharedArray.create(pvm_shape, COMPUTE_DTYPE, fill=1.0 / self.__coin_no) if share_pvm else None
+    self.__PVM = self.__shared_pvm.array if share_pvm else np.full(pvm_shape, 1.0 / self.__coin_no, dtype=COMPUTE_DTYPE)
     logger.info(f'Portfolio Vector Memory: PVM(head)')
-    logger.info(self.__PVM.head(10))
+    logger.info(self.global_weights.head(10))
 
     self._window_size = window_size
     logger.info(f'_window_size: {self._window_size}')
-    self._num_periods = self.__global_data.index.levshape[1]
+    self._num_periods = self.__global_data_array.shape[2]
     logger.info(f'_num_periods: {self._num_periods}')
+    # read only view of every window, [sample index, feature, coin, window_size + 1]
+    self.__windows = sliding_window_view(self.__global_data_array, window_size + 1, axis=2).transpose(2, 0, 1, 3)
     self.__divide_data(test_portion, portion_reversed)
 
     self._portion_reversed = portion_reversed
@@ -118,12 +210,34 @@ class DataMatrices:
 
   @property
   def global_weights(self):
+    """the portfolio vector memory as a data frame indexed by time, built on demand"""
+    return pd.DataFrame(self.__PVM, index=self.time_index, columns=self.__coins)
+
+  @property
+  def time_index(self):
+    """the timestamps of the time axis of the global data"""
+    return pd.to_datetime(self.__time_axis, unit="s")
+
+  @property
+  def pvm(self):
+    """the portfolio vector memory, a COMPUTE_DTYPE array of shape [time, assets]"""
     return self.__PVM
 
+  @property
+  def storage_dtype(self):
+    """the dtype the global data is stored in"""
+    return self.__global_data_array.dtype
+
+  @property
+  def pvm_descriptor(self):
+    """the SharedArray descriptor another process can attach the portfolio vector memory with, None if it is not shared"""
+    return self.__shared_pvm.descriptor if self.__shared_pvm is not None else None
+
   @staticmethod
-  def create_from_config(config):
+  def create_from_config(config, global_data=None):
     """main method to create the DataMatrices in this project
         @:param config: config dictionary
+        @:param global_data: the global data shared by another process, see share_global_data
         @:return: a DataMatrices object
         """
     config = config.copy()
@@ -146,15 +260,83 @@ class DataMatrices:
         volume_average_days=input_config["volume_average_days"],
         test_portion=input_config["test_portion"],
         portion_reversed=input_config["portion_reversed"],
+        download_workers=input_config["download_workers"],
+        requests_per_second=input_config["requests_per_second"],
+        panel_cache_size_mb=input_config["panel_cache_size_mb"],
+        data_dir=input_config["data_dir"],
+        global_data=global_data,
+        save_memory_mode=input_config["save_memory_mode"],
+        storage_dtype=input_config["storage_dtype"],
+        fake_data=input_config["fake_data"],
+        fake_seed=config["random_seed"],
     )
 
   @property
   def global_matrix(self):
-    return self.__global_data
+    """the global data as a multi index data frame, built on demand"""
+    return array_to_panel(self.__global_data_array, self.__coins, self.time_index, self.__features)
 
   @property
   def coin_list(self):
-    return self.__history_manager.coins
+    return self.__coins
+
+  @property
+  def save_memory_mode(self):
+    return self.__save_memory_mode
+
+  @staticmethod
+  def __to_storage(array, dtype):
+    """converts the global data to its storage dtype, without a copy if it is already stored so"""
+    if array.dtype == dtype:
+      return array
+    stored = array.astype(dtype)
+    if np.isinf(stored).any() and not np.isinf(array).any():
+      logger.warning(f"some values of the global data overflow {dtype}, use a wider storage_dtype")
+    logger.info(f'global data matrix stored as {dtype}')
+    return stored
+
+  @staticmethod
+  def __create_memmap(shape, dtype):
+    """returns a memory map of a temporary file in MEMMAP_DIR"""
+    os.makedirs(MEMMAP_DIR, exist_ok=True)
+    # the file is deleted when closed but stays mapped until the memmap is garbage collected
+    with tempfile.NamedTemporaryFile(dir=MEMMAP_DIR, suffix=".dat") as f:
+      return np.memmap(f, dtype=dtype, mode="w+", shape=shape)
+
+  @staticmethod
+  def __to_memmap(array, dtype):
+    """copies the global data to a memory mapped temporary file of dtype, one coin at a time"""
+    if isinstance(array, np.memmap) and array.dtype == dtype:
+      return array
+    mapped = DataMatrices.__create_memmap(array.shape, dtype)
+    overflow = False
+    for coin_index in range(array.shape[1]):
+      mapped[:, coin_index] = array[:, coin_index]
+      overflow = overflow or bool(np.isinf(mapped[:, coin_index]).any())
+    if overflow:
+      logger.warning(f"some values of the global data overflow {dtype}, use a wider storage_dtype")
+    mapped.flush()
+    logger.info(f'global data matrix memory mapped as {dtype}')
+    return mapped
+
+  @property
+  def global_data(self):
+    """the global_data parameter of another DataMatrices of this process over the same data, a read only view without any copy"""
+    array = self.__global_data_array.view()
+    array.flags.writeable = False
+    return {"array": array, "coins": list(self.__coins)}
+
+  def share_global_data(self):
+    """
+
+        Copies the global data array to shared memory so that other processes can build their DataMatrices without
+        loading it again, see the global_data parameter. The shared memory is freed once the returned SharedArray is
+        closed, which must only happen after the other processes are done.
+
+        :return: (shared, global_data) the SharedArray owning the copy and the picklable global_data to pass on
+        """
+    shared = SharedArray.from_array(self.__global_data_array)
+    return shared, {"array": shared.descriptor, "coins": list(self.__coins)}
 
   @property
   def num_train_samples(self):
@@ -178,41 +360,163 @@ class DataMatrices:
     appended_index = self._train_ind[-1]
     self.__replay_buffer.append_experience(appended_index)
 
+  def extend(self, until):
+    """
+
+        Appends the periods following the current end of the global data up to until, e.g. the new candles of a live
+        trading session. Only the new periods are fetched and queried, and they are copied into buffers which grow
+        geometrically, so a step costs O(new periods) amortized instead of reloading the whole history.
+
+        The new periods are forward filled from the last known values, their PVM rows start as the uniform
+        portfolio. They extend the test set, unless portion_reversed: the training set is then the most recent one and
+        the new periods are added to it and to the replay buffer by append_experience, which the rolling trainer calls
+        once per step. It must not be called while a BatchPrefetcher is running.
+
+        :param until: unix time, the new end of the global data
+        :return: the number of periods appended
+        """
+    if self.__history_manager is None:
+      raise ValueError("the global data is synthetic or shared by another process and can not be extended")
+    if self.__save_memory_mode or self.__shared_pvm is not None:
+      raise ValueError("memory mapped global data or shared PVM can not be extended")
+    period = self.__period_length
+    first = int(self.__time_axis[-1]) + period
+    last = int(until) - int(until) % period
+    if last < first:
+      return 0
+    new_data = self.__history_manager.get_global_data_extension(first, last, period, self.__features)
+    appended = new_data.shape[2]
+    num_periods = self._num_periods
+    self.__reserve(appended)
+    global_buffer, pvm_buffer, time_buffer = self.__buffers
+    # continue every series from its last known value
+    global_buffer[:, :, num_periods:num_periods + appended] = array_fillna(
+        np.concatenate((self.__global_data_array[:, :, -1:], new_data), axis=2), "ffill")[:, :, 1:]
+    pvm_buffer[num_periods:num_periods + appended] = 1.0 / self.__coin_no
+    time_buffer[num_periods:num_periods + appended] = np.arange(first, last + 1, period)
+
+    self._num_periods = num_periods + appended
+    self.__global_data_array = global_buffer[:, :, :self._num_periods]
+    self.__PVM = pvm_buffer[:self._num_periods]
+    self.__time_axis = time_buffer[:self._num_periods]
+    self.__windows = sliding_window_view(self.__global_data_array, self._window_size + 1, axis=2).transpose(2, 0, 1, 3)
+    self.__end = last
+
+    if not self._portion_reversed:
+      self._test_ind = np.concatenate((self._test_ind, np.arange(num_periods, self._num_periods)))
+    self._num_test_samples = len(self.test_indices)
+    self._num_train_samples = len(self._train_ind)
+    logger.info(f"extended the global data by {appended} periods up to {last}, {self._num_periods} periods")
+    return appended
+
+  def __reserve(self, periods):
+    """makes room for periods more periods in the global data, PVM and time axis buffers"""
+    needed = self._num_periods + periods
+    if self.__buffers is not None and self.__buffers[0].shape[2] >= needed:
+      return
+    capacity = max(needed, int(self._num_periods * GROWTH_FACTOR))
+    global_buffer = np.empty(self.__global_data_array.shape[:2] + (capacity,), dtype=self.__global_data_array.dtype)
+    global_buffer[:, :, :self._num_periods] = self.__global_data_array
+    pvm_buffer = np.empty((capacity, self.__PVM.shape[1]), dtype=self.__PVM.dtype)
+    pvm_buffer[:self._num_periods] = self.__PVM
+    time_buffer = np.empty(capacity, dtype=np.int64)
+    time_buffer[:self._num_periods] = self.__time_axis
+    self.__buffers = (global_buffer, pvm_buffer, time_buffer)
+
   def get_test_set(self):
     return self.__pack_samples(self.test_indices)
 
+  def get_latest_window(self):
+    """the last window_size periods of the global data [features, coins, window_size], the input of the agent for the next period"""
+    return self.__global_data_array[:, :, -self._window_size:].astype(COMPUTE_DTYPE)
+
   def get_training_set(self):
-    return self.__pack_samples(self._train_ind[:-self._window_size])
+    return self.__pack_samples(self.training_indices)
+
+  @property
+  def training_indices(self):
+    return self._train_ind[:-self._window_size]
+
+  def iter_samples(self, indexs, chunk_size, last_w=None):
+    """
+        yields the samples of indexs in chunks of chunk_size, so that only one chunk of windows is in memory at once
 
-  def next_batch(self):
+        Every chunk but the first starts with the last sample of the previous chunk, so that the terms depending on
+        the previous sample (the commission) can be computed, the results of that first row must then be dropped.
+        @:param last_w: the last_w of every sample of indexs, e.g. a snapshot, instead of the portfolio vector memory
+        @:return: generator of (overlap, batch), overlap being the number of leading rows of the previous chunk (0 or 1)
+        and batch a dictionary in the format of next_batch whose X is a COMPUTE_DTYPE copy
+        """
+    indexs = np.asarray(indexs, dtype=np.int64)
+    chunk_size = max(1, int(chunk_size))
+    for start in range(0, len(indexs), chunk_size):
+      overlap = 1 if start > 0 else 0
+      rows = slice(start - overlap, min(start + chunk_size, len(indexs)))
+      batch = self.__pack_samples(indexs[rows])
+      batch["X"] = np.ascontiguousarray(batch["X"], dtype=COMPUTE_DTYPE)
+      if last_w is not None:
+        batch["last_w"] = last_w[rows]
+      yield overlap, batch
+
+  def next_batch(self, with_last_w=True):
     """
+        @:param with_last_w: if False "last_w" is None, it is then read with read_last_w(batch["indexs"]) when the
+        batch is consumed, e.g. by a BatchPrefetcher
         @:return: the next batch of training sample. The sample is a dictionary
         with key "X"(input data); "y"(future relative price); "last_w" a numpy array
         with shape [batch_size, assets]; "w" a list of numpy arrays list length is
         batch_size
         """
-    batch = self.__pack_samples([exp.state_index for exp in self.__replay_buffer.next_experience_batch()])
+    batch = self.__pack_samples(self.__replay_buffer.next_experience_batch(), with_last_w=with_last_w)
     return batch
 
-  def __pack_samples(self, indexs):
-    indexs = np.array(indexs)
-    last_w = self.__PVM.values[indexs - 1, :]
+  def read_last_w(self, indexs):
+    """returns a copy of the portfolio weights preceding the samples indexs, [samples, assets]"""
+    return self.__PVM[np.asarray(indexs) - 1]
+
+  def write_w(self, indexs, w):
+    """writes the portfolio weights w [samples, assets] of the samples indexs to the portfolio vector memory"""
+    self.__PVM[np.asarray(indexs)] = w
+
+  def check_nan(self):
+    """
+        raises a ValueError if the global data or the portfolio vector memory hold nan, one coin at a time so that a
+        memory mapped global data is not loaded at once. The samples packed afterwards need not be checked one by one
+        """
+    for coin_index, coin in enumerate(self.__coins):
+      if np.isnan(self.__global_data_array[:, coin_index]).any():
+        raise ValueError(f"the global data of {coin} holds nan")
+    if np.isnan(self.__PVM).any():
+      raise ValueError("the portfolio vector memory holds nan")
+
+  def __pack_samples(self, indexs, with_last_w=True):
+    """
+
+        Packs the windows starting at indexs into X [samples, features, coins, window_size] and y [samples, features, coins].
+
+        Consecutive indexs (the training and test sets) are returned as read only views of the global data array,
+        without any copy. They are in its storage dtype, which is COMPUTE_DTYPE unless in save_memory_mode where the
+        views are converted chunk by chunk by iter_samples. Other indexs (the mini batches) are gathered with a single
+        fancy index over the windows. y is always COMPUTE_DTYPE.
+
+        """
+    indexs = np.asarray(indexs, dtype=np.int64)
+    last_w = self.__PVM[indexs - 1] if with_last_w else None
 
     def setw(w):
-      self.__PVM.iloc[indexs, :] = w
+      self.write_w(indexs, w)
 
-    M = [self.get_submatrix(index) for index in indexs]
-    M = np.array(M)
+    if len(indexs) > 0 and indexs[-1] - indexs[0] == len(indexs) - 1 and np.all(np.diff(indexs) == 1):
+      M = self.__windows[indexs[0]:indexs[-1] + 1]
+    else:
+      M = self.__windows[indexs].astype(COMPUTE_DTYPE, copy=False)
     X = M[:, :, :, :-1]
-    y = M[:, :, :, -1] / M[:, 0, None, :, -2]
-    return {"X": X, "y": y, "last_w": last_w, "setw": setw}
+    y = np.divide(M[:, :, :, -1], M[:, 0, None, :, -2], dtype=COMPUTE_DTYPE)
+    return {"X": X, "y": y, "last_w": last_w, "setw": setw, "indexs": indexs}
 
   # volume in y is the volume in next access period
   def get_submatrix(self, ind):
     #logger.info(f'extracting training-data indicies [{ind} -> {ind+self._window_size+1}]')
-    gd = self.__global_data
-    dta = self.__global_data_array
-    sl = self.__global_data_array[:, :, ind:ind + self._window_size + 1]
     return self.__global_data_array[:, :, ind:ind + self._window_size + 1]
 
   def __divide_data(self, test_portion, portion_reversed):
@@ -0,0 +1,169 @@
+from __future__ import absolute_import, division, print_function
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from models.pgportfolio.constants import DAY
+from models.pgportfolio.marketdata.provider import DataProvider, CHART_COLUMNS, FILE
+
+from common.custom_logger2 import get_custom_logger
+
+logger = get_custom_logger(__name__)
+
+# archive formats, in the order they are looked for
+ARCHIVE_EXTENSIONS = (".parquet", ".csv", ".csv.gz")
+
+
+class FileReplayProvider(DataProvider):
+  """
+
+    Data provider replaying candles from local archives, without any network access.
+
+    data_dir holds one archive per pair named after it, e.g. BTC_ETH.parquet, BTC_XMR.csv or USDT_BTC.csv.gz,
+    with one row per candle and the CHART_COLUMNS as columns ("quoteVolume" and "weightedAverage" are
+    optional). Dates are unix timestamps of the start of the candles, or datetimes. All the archives should
+    share the same candle period, e.g. 5 minutes, and coarser periods are aggregated on the fly.
+
+    Each archive is read once and kept in memory as numpy arrays, so charts are served by a binary search and
+    a vectorized aggregation.
+
+    Args:
+        data_dir (str): the directory of the archives
+        clock (int, optional): the replayed current time, used by marketVolume and marketTicker.
+            Defaults to None, the end of each archive.
+    """
+
+  name = FILE
+
+  def __init__(self, data_dir: str, clock: int = None):
+    if not os.path.isdir(data_dir):
+      raise ValueError(f"data_dir {data_dir} is not a directory")
+    self._data_dir = data_dir
+    self._clock = clock
+    self._paths = {}
+    for filename in sorted(os.listdir(data_dir)):
+      for extension in ARCHIVE_EXTENSIONS:
+        if filename.endswith(extension):
+          self._paths.setdefault(filename[:-len(extension)], os.path.join(data_dir, filename))
+          break
+    self._candles = {}
+    self._lock = threading.Lock()
+    logger.info(f"replaying {len(self._paths)} pairs from {data_dir}")
+
+  def activePairs(self) -> list:
+    return list(self._paths)
+
+  def marketVolume(self) -> dict:
+    volumes = {}
+    for pair, candles in self.__traded_pairs():
+      base, quote = pair.split("_", 1)
+      volumes[pair] = {base: float(candles[:, 5].sum()), quote: float(candles[:, 6].sum())}
+    return volumes
+
+  def marketTicker(self) -> dict:
+    ticker = {}
+    for pair, candles in self.__traded_pairs():
+      ticker[pair] = {
+          "last": float(candles[-1, 4]),
+          "baseVolume": float(candles[:, 5].sum()),
+          "quoteVolume": float(candles[:, 6].sum()),
+          "isFrozen": "0",
+      }
+    return ticker
+
+  def marketChart(self, pair: str, period: int, start: int, end: int) -> list:
+    candles = self.chartArray(pair, period, start, end)
+    return [dict(zip(CHART_COLUMNS, row)) for row in candles.tolist()]
+
+  def chartArray(self, pair: str, period: int, start: int, end: int) -> np.ndarray:
+    """returns the candles of the pair dated in [start, end], aggregated to period, without building any dict"""
+    candles = self.__load(pair)
+    period = int(period)
+    first_bucket = int(start) + (-int(start)) % period
+    last_bucket = int(end) - int(end) % period
+    if last_bucket < first_bucket:
+      return candles[:0]
+    dates = candles[:, 0]
+    candles = candles[np.searchsorted(dates, first_bucket, side="left"):np.searchsorted(dates, last_bucket + period, side="left")]
+    if len(candles) == 0 or period <= self.__base_period(pair):
+      return candles
+    return aggregate_chart(candles, period)
+
+  def __traded_pairs(self):
+    """yields the pairs with candles in the last day and those candles, marketVolume and marketTicker list the same pairs"""
+    for pair in self._paths:
+      candles = self.__last_day(pair)
+      if len(candles) > 0:
+        yield pair, candles
+
+  def __last_day(self, pair: str) -> np.ndarray:
+    candles = self.__load(pair)
+    clock = candles[-1, 0] + 1 if self._clock is None and len(candles) else self._clock or 0
+    dates = candles[:, 0]
+    return candles[np.searchsorted(dates, clock - DAY, side="left"):np.searchsorted(dates, clock, side="left")]
+
+  def __base_period(self, pair: str) -> int:
+    dates = self.__load(pair)[:, 0]
+    if len(dates) < 2:
+      return 0
+    return int(np.diff(dates).min())
+
+  def __load(self, pair: str) -> np.ndarray:
+    candles = self._candles.get(pair)
+    if candles is not None:
+      return candles
+    with self._lock:
+      if pair not in self._candles:
+        self._candles[pair] = read_archive(self._paths[pair]) if pair in self._paths else np.empty((0, len(CHART_COLUMNS)))
+      return self._candles[pair]
+
+
+def read_archive(path: str) -> np.ndarray:
+  """reads a candle archive into a float64 array of shape [n, len(CHART_COLUMNS)] sorted by date
+
+  Args:
+      path (str): a parquet, csv or csv.gz file with the CHART_COLUMNS as columns
+
+  Returns:
+      np.ndarray: the candles, unique by date
+  """
+  if path.endswith(".parquet"):
+    df = pd.read_parquet(path)
+  else:
+    df = pd.read_csv(path)
+  if pd.api.types.is_datetime64_any_dtype(df["date"]):
+    df["date"] = df["date"].astype("int64") // 10**9
+  if "quoteVolume" not in df:
+    df["quoteVolume"] = 0.0
+  if "weightedAverage" not in df:
+    df["weightedAverage"] = df["close"]
+  candles = df[list(CHART_COLUMNS)].to_numpy(dtype=np.float64)
+  candles = candles[np.argsort(candles[:, 0], kind="stable")]
+  # keep the last row of duplicated dates
+  unique = np.r_[candles[1:, 0] != candles[:-1, 0], True]
+  logger.info(f"loaded {int(unique.sum())} candles from {path}")
+  return candles[unique]
+
+
+def aggregate_chart(candles: np.ndarray, period: int) -> np.ndarray:
+  """aggregates sorted CHART_COLUMNS candles into candles of period seconds, dated by the start of their period"""
+  buckets = candles[:, 0] - candles[:, 0] % period
+  starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+  ends = np.r_[starts[1:], len(candles)] - 1
+  volume = np.add.reduceat(candles[:, 5], starts)
+  quote_volume = np.add.reduceat(candles[:, 6], starts)
+  close = candles[ends, 4]
+  with np.errstate(divide="ignore", invalid="ignore"):
+    weighted_average = np.where(quote_volume > 0, volume / quote_volume, close)
+  return np.column_stack((
+      buckets[starts],
+      np.maximum.reduceat(candles[:, 1], starts),
+      np.minimum.reduceat(candles[:, 2], starts),
+      candles[starts, 3],
+      close,
+      volume,
+      quote_volume,
+      weighted_average,
+  ))
@@ -5,19 +5,35 @@ from __future__ import print_function
 from common.db import MariaDB
 
 from models.pgportfolio.marketdata.coinlist import CoinList
+from models.pgportfolio.marketdata.poloniex import DEFAULT_REQUESTS_PER_SECOND
+from models.pgportfolio.marketdata.panelcache import PanelCache
+from models.pgportfolio.marketdata.provider import DataProvider, CHART_COLUMNS, POLONIEX
 import numpy as np
 import pandas as pd
-from models.pgportfolio.tools.data import panel_fillna
+from models.pgportfolio.tools.data import array_fillna, array_to_panel, merge_intervals, subtract_intervals
 from models.pgportfolio.constants import *
 from datetime import datetime
 import time
-from tabulate import tabulate
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from common.custom_logger2 import get_custom_logger, get_custom_training_logger
 
 logger = get_custom_logger(__name__)
 training_logger = get_custom_training_logger(__name__)
 
+# column order of the Mkt_History_Px table
+HISTORY_COLUMNS = ("date", "coin", "high", "low", "open", "close", "volume", "quoteVolume", "weightedAverage")
+# how each feature is aggregated from the 5 minute candles to a coarser period
+FEATURE_AGGREGATIONS = {"close": "last", "open": "first", "high": "max", "low": "min", "volume": "sum"}
+# periods with a rollup table maintained from the 5 minute candles
+ROLLUP_PERIODS = (FIFTEEN_MINUTES, HALF_HOUR, TWO_HOUR, FOUR_HOUR, DAY)
+# aggregation of each of HISTORY_COLUMNS[2:] into a rollup, the last column holds weightedAverage * volume
+ROLLUP_AGGREGATIONS = ("max", "min", "first", "last", "sum", "sum", "sum")
+# name of the migration building the rollup tables of a history stored before they existed, see HistoryManager.migrate_db
+ROLLUP_MIGRATION = "rollups"
+# number of (coin, chunk) downloads run at the same time
+DEFAULT_DOWNLOAD_WORKERS = 4
+
 
 class HistoryManager:
   """
@@ -26,27 +42,43 @@ class HistoryManager:
 
     Maintains coinlist with the top N coins.
     Once the top coins are selected for a given period, get all the historical data for the period specified in the config
-    from the data provider (poloniex etc.,) and save to MariaDB, if only data doesn't already exist in the DB.
+    from the data provider (poloniex, local archives etc., see DataProvider) and save to MariaDB, if only data doesn't already exist in the DB.
 
     Retrieves the global panel
 
 
     Main Methods:
+        get_global_data_matrix - returns a [feature, coin, time] array for top N coins according to config using data from DB
         get_global_panel - returns a multi-index dataframe of features per coin/timestamp for top N coins according to config using data from DB
         select_coins - returns top N coins by volume over given start/end period
         update_data - between given start-end and for a given coin, fill in any gaps in data in the DB by fetching from data provider and saving
+        update_coins_data - same as update_data for a list of coins, fetching several coins/chunks concurrently
 
     """
 
   # if offline ,the coin_list could be None
   # NOTE: return of the mariadb results is a list of tuples, each tuple is a row
-  def __init__(self, coin_number, end, volume_average_days=1, volume_forward=0, online=True):
-    self.initialize_db()
+  def __init__(self,
+               coin_number,
+               end,
+               volume_average_days=1,
+               volume_forward=0,
+               online=True,
+               insert_batch_size=1000,
+               max_workers=DEFAULT_DOWNLOAD_WORKERS,
+               requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+               panel_cache: PanelCache = None,
+               provider: DataProvider = None):
+    self.__panel_cache = panel_cache
     self.__storage_period = FIVE_MINUTES  # keep this as 300
+    self.__insert_batch_size = insert_batch_size
+    self.__max_workers = max(1, int(max_workers))
+    self.initialize_db()
     self._coin_number = coin_number
-    self._online = online
+    # a local provider, e.g. FILE, replays archives without any network access, so it is used even offline
+    self._online = online or (provider is not None and provider.name != POLONIEX)
     if self._online:
-      self._coin_list = CoinList(end, volume_average_days, volume_forward)
+      self._coin_list = CoinList(end, volume_average_days, volume_forward, requests_per_second=requests_per_second, max_workers=self.__max_workers, provider=provider)
     self.__volume_forward = volume_forward
     self.__volume_average_days = volume_average_days
     self.__coins = None
@@ -56,8 +88,93 @@ class HistoryManager:
     return self.__coins
 
   def initialize_db(self):
+    db = MariaDB()
+    for table in [history_table(FIVE_MINUTES)] + [history_table(period) for period in ROLLUP_PERIODS]:
+      self.__create_history_table(db, table)
+
+    # contiguous intervals of 5 minute candle dates already fetched from the data provider, per coin
+    create_coverage_qry = f"""
+      CREATE TABLE IF NOT EXISTS `Mkt_History_Coverage` (
+      `coin` varchar(20) NOT NULL,
+      `start` int(10) unsigned NOT NULL,
+      `end` int(10) unsigned NOT NULL,
+      PRIMARY KEY (`coin`,`start`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """
+    db.update_or_delete_data(create_coverage_qry)
+
+    # one row per chunk of history stored, used to version the data of a coin/date range, see record_ingest
+    create_ingest_log_qry = f"""
+      CREATE TABLE IF NOT EXISTS `Mkt_History_Ingest_Log` (
+      `id` bigint unsigned NOT NULL AUTO_INCREMENT,
+      `coin` varchar(20) NOT NULL,
+      `start` int(10) unsigned NOT NULL,
+      `end` int(10) unsigned NOT NULL,
+      `rows` int(10) unsigned NOT NULL,
+      `ingested_at` int(10) unsigned NOT NULL,
+      PRIMARY KEY (`id`),
+      KEY `coin_range` (`coin`,`start`,`end`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """
+    db.update_or_delete_data(create_ingest_log_qry)
+
+    # one row per migration run to completion by migrate_db
+    create_migrations_qry = f"""
+      CREATE TABLE IF NOT EXISTS `Mkt_History_Migrations` (
+      `name` varchar(64) NOT NULL,
+      `completed_at` int(10) unsigned NOT NULL,
+      PRIMARY KEY (`name`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """
+    db.update_or_delete_data(create_migrations_qry)
+
+    # the rollups of a history stored before they existed are built by migrate_db, until then the 5 minute candles are read
+    self.__rollups_ready = self.migration_completed(ROLLUP_MIGRATION)
+    if not self.__rollups_ready and len(db.qry_read_data("SELECT `date` FROM Mkt_History_Px LIMIT 1")) == 0:
+      # nothing to rebuild, the rollups of new candles are maintained by update_coins_data
+      self.__mark_migration_completed(ROLLUP_MIGRATION)
+      self.__rollups_ready = True
+    if not self.__rollups_ready:
+      logger.warning("the rollup tables were not built from the stored history, the candles are aggregated from Mkt_History_Px "
+                     "until `python main.py --mode=migrate_db` is run")
+
+  @staticmethod
+  def migration_completed(name: str) -> bool:
+    """returns whether the migration name was run to completion"""
+    db = MariaDB()
+    return len(db.qry_read_data(f"SELECT name FROM Mkt_History_Migrations WHERE name = '{name}'")) > 0
+
+  @staticmethod
+  def __mark_migration_completed(name: str) -> None:
+    db = MariaDB()
+    db.update_or_delete_data(f"""
+      INSERT INTO Mkt_History_Migrations (name, completed_at) VALUES ('{name}', {int(time.time())})
+      ON DUPLICATE KEY UPDATE completed_at = VALUES(completed_at)
+    """)
+
+  def migrate_db(self) -> None:
+    """
+
+        Runs the migrations of the history tables which have not been completed yet, currently the rebuild of the
+        rollup tables from Mkt_History_Px.
+
+        A migration is marked as completed in Mkt_History_Migrations once it has run to the end, so a migration
+        interrupted by a crash is run again from the start by the next call. Rebuilding the rollups only upserts rows,
+        so running it again is safe.
+
+        """
+    if self.migration_completed(ROLLUP_MIGRATION):
+      logger.info("the rollup tables are up to date")
+      return
+    self.rebuild_rollups()
+    self.__mark_migration_completed(ROLLUP_MIGRATION)
+    self.__rollups_ready = True
+    logger.info("the rollup tables were rebuilt")
+
+  @staticmethod
+  def __create_history_table(db: MariaDB, table: str) -> None:
     create_table_if_not_exists_qry = f"""
-      CREATE TABLE IF NOT EXISTS `Mkt_History_Px` (
+      CREATE TABLE IF NOT EXISTS `{table}` (
       `date` int(10) unsigned NOT NULL,
       `coin` varchar(20) NOT NULL,
       `high` float DEFAULT NULL,
@@ -70,15 +187,81 @@ class HistoryManager:
       PRIMARY KEY (`date`,`coin`)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
     """
-
-    db = MariaDB()
     db.update_or_delete_data(create_table_if_not_exists_qry)
 
-  def get_global_data_matrix(self, start, end, period=300, features=("close",)):
+  def get_global_data_matrix(self, start: int, end: int, period: int = 300, features: tuple = ("close",), out: np.ndarray = None) -> np.ndarray:
+    """
+        Selects the top N coins, fills in any missing history and loads the global data matrix of the selected coins.
+        If the history manager has a panel cache, the matrix is read from / written to it.
+
+        The coins of the matrix are available through the coins property and its time axis through get_time_axis.
+
+        :param start/end: linux timestamp in seconds
+        :param period: time interval of each data access point
+        :param features: tuple or list of the feature names
+        :param out: optional [feature, coin, time] array, e.g. a memory map, the matrix is written into one coin at a
+        time so that it is never held in RAM as a whole, see load_global_array
+        :return a float32 numpy ndarray whose axis is [feature, coin, time], or out
+        """
+    period = int(period)
+    self.__checkperiod(period)
+    start = int(start - (start % period))
+    end = int(end - (end % period))
+    coins = self.select_coins(start=end - self.__volume_forward - self.__volume_average_days * DAY, end=end - self.__volume_forward)
+    self.__coins = coins
+    # the first period aggregates the candles of [start - period, start)
+    self.update_coins_data(start - period, end, coins)
+    if len(coins) != self._coin_number:
+      raise ValueError("the length of selected coins %d is not equal to expected %d" % (len(coins), self._coin_number))
+
+    logger.info("feature type list is %s" % str(features))
+    training_logger.info("feature type list is %s" % str(features))
+    if self.__panel_cache is None:
+      return self.load_global_array(coins, start, end, period, features, out=out)
+
+    key = PanelCache.make_key(coins, start, end, period, features, self.get_data_version(coins, start - period, end))
+    cached = self.__panel_cache.load(key)
+    if cached is not None and out is None:
+      return cached[0]
+    if cached is not None:
+      # the cached entry is memory mapped too, it is paged through one coin at a time
+      for coin_index in range(len(coins)):
+        out[:, coin_index] = cached[0][:, coin_index]
+      return out
+    global_array = self.load_global_array(coins, start, end, period, features, out=out)
+    # the cache holds float32 matrices, the ones written in a narrower storage dtype are not cached
+    if global_array.dtype == np.float32:
+      self.__panel_cache.store(key, global_array, coins, self.get_time_axis(start, end, period))
+    return global_array
+
+  def get_data_version(self, coins: list, start: int, end: int) -> list:
     """
-        :return a numpy ndarray whose axis is [feature, coin, time]
+
+        Returns a value identifying the state of the history of the coins between start and end.
+
+        It is the id of the last ingest recorded for each coin overlapping [start, end], read from the small
+        Mkt_History_Ingest_Log through its coin_range index instead of scanning the candles, so it changes whenever
+        rows are stored for the range. Candles written to Mkt_History_Px by other tools must be recorded with
+        record_ingest to invalidate the cached panels.
+
         """
-    return self.get_global_panel(start, end, period, features).values
+    coins_as_str = "'{}'".format("','".join(coins))
+    version_qry = f"""
+      SELECT coin, MAX(id) AS version FROM Mkt_History_Ingest_Log
+      WHERE coin IN ({coins_as_str}) AND `start` <= {int(end)} AND `end` >= {int(start)}
+      GROUP BY coin
+      ORDER BY coin
+    """
+    db = MariaDB()
+    version_df = db.qry_read_data(version_qry)
+    return [[coin, int(version)] for coin, version in zip(version_df["coin"], version_df["version"])]
+
+  @staticmethod
+  def record_ingest(coin: str, start: int, end: int, rows: int) -> None:
+    """records that rows candles of coin dated between start and end were written to Mkt_History_Px, see get_data_version"""
+    db = MariaDB()
+    db.insert_list_data("INSERT INTO Mkt_History_Ingest_Log (coin, `start`, `end`, `rows`, ingested_at) VALUES (%s,%s,%s,%s,%s)",
+                        [(coin, int(start), int(end), int(rows), int(time.time()))])
 
   def get_global_panel(self, start: int, end: int, period: int = 300, features: tuple = ("close",)) -> pd.DataFrame:
     """
@@ -89,155 +272,133 @@ class HistoryManager:
         -----+---------------------+-----------+-----------+-----|
         LTC  | 2016-10-01 09:00:00 | 170.98    | 169.56    | ... |
 
-        First it gets a list of coins with greatest volume for given start/end period
-        It also calls update_data to fill in all the historic data between start and end
+        This is a data frame view of get_global_data_matrix, mostly useful for inspection.
 
         :param start/end: linux timestamp in seconds
         :param period: time interval of each data access point
         :param features: tuple or list of the feature names
         :return a panel, [feature, coin, time]
         """
+    global_array = self.get_global_data_matrix(start, end, period, features)
+    time_index = pd.to_datetime(self.get_time_axis(start, end, period), unit="s")
+    return array_to_panel(global_array, self.__coins, time_index, features)
+
+  @staticmethod
+  def get_time_axis(start: int, end: int, period: int) -> np.ndarray:
+    """returns the unix timestamps of the time axis of the global data matrix between start and end"""
+    period = int(period)
     start = int(start - (start % period))
     end = int(end - (end % period))
-    coins = self.select_coins(start=end - self.__volume_forward - self.__volume_average_days * DAY, end=end - self.__volume_forward)
-    self.__coins = coins
-    for coin in coins:
-      self.update_data(start, end, coin)
-    if len(coins) != self._coin_number:
-      raise ValueError("the length of selected coins %d is not equal to expected %d" % (len(coins), self._coin_number))
+    return np.arange(start, end + 1, period, dtype=np.int64)
 
-    logger.info("feature type list is %s" % str(features))
-    training_logger.info("feature type list is %s" % str(features))
-    self.__checkperiod(period)
+  def get_global_data_extension(self, start: int, end: int, period: int, features: tuple) -> np.ndarray:
+    """
 
-    # Index is multi-index per instrument / per date time
-    # First (major) layer is instrument
-    # Second (minor) layer is date time
-    # The columns are the features (close, high, low etc.,)
-    time_index = pd.to_datetime(list(range(start, end + 1, period)), unit="s")
-    multi_index = pd.MultiIndex.from_product([coins, time_index], names=["major", "minor"])
-    panel = pd.DataFrame(dtype=np.float32, index=multi_index, columns=features)
-
-    logger.info(f"coins: {coins}")
-    logger.info(f"time index: {time_index}")
-    logger.info(f"multi index: {multi_index}")
-    logger.info(f"type(time_index): {type(time_index)}")
-    logger.info(f"type(multi_index): {type(multi_index)}")
-    logger.info(f"features: {features}")
-    logger.info(f"-----------------------------------------------------------")
-    logger.info(f"panel.head(): {panel.head()}")
-    logger.info(f"panel.index: {panel.index}")
-    logger.info(f"panel.dtypes: {panel.dtypes}")
-    logger.info(f"-----------------------------------------------------------")
+        Returns the [feature, coin, time] array of the coins already selected by get_global_data_matrix between
+        start and end, after fetching their missing candles, e.g. the periods following a global data matrix.
 
-    db = MariaDB()
+        Only the new range is fetched and queried. Gaps are left as nan for the caller to fill from the periods
+        it already holds.
+
+        Args:
+            start (int): start timestamp, aligned to period
+            end (int): end timestamp, aligned to period
+            period (int): the period of the time axis
+            features (tuple): the features to load, in the order of the feature axis
+
+        Returns:
+            np.ndarray: float32 array whose axis is [feature, coin, time]
+        """
+    if self.__coins is None:
+      raise ValueError("get_global_data_matrix must select the coins before the data can be extended")
+    self.update_coins_data(start - period, end, self.__coins)
+    return self.load_global_array(self.__coins, start, end, period, features, fill_type=None)
+
+  def load_global_array(self, coins: list, start: int, end: int, period: int, features: tuple, fill_type: str = "both",
+                        out: np.ndarray = None) -> np.ndarray:
+    """
+
+        Loads all the requested coins and features between start and end with a single ranged query on the
+        rollup table of period (or the raw 5 minute candles for periods without rollup), then aggregates them
+        to period in numpy.
+
+        If out is given the coins are queried, aggregated and written into it one at a time instead, so that only
+        the candles and the rows of a single coin are in RAM, e.g. to fill a memory map larger than the RAM.
+
+        The value at time T aggregates the candles whose date is in [T - period, T), i.e. the close at T is the
+        close of the last 5 minute candle ending at T. Gaps are back filled then forward filled along time.
+
+        Args:
+            coins (list): the coins to load, in the order of the coin axis
+            start (int): start timestamp, aligned to period
+            end (int): end timestamp, aligned to period
+            period (int): the period of the time axis
+            features (tuple): the features to load, in the order of the feature axis
+            fill_type (str, optional): how gaps are filled, see array_fillna, None to keep them. Defaults to "both".
+            out (np.ndarray, optional): the [feature, coin, time] array to write into. Defaults to None.
 
-    for row_number, coin in enumerate(coins):
-      logger.info("**********************************************************************")
-      process_line = ('*' * 20)
-      process_line += ' ' + f'Processing {coin}'.ljust(29)
-      process_line += ('*' * 20)
-      logger.info(process_line)
-      logger.info("**********************************************************************")
-      training_logger.info('Processng historic data for: ' + coin)
+        Returns:
+            np.ndarray: float32 array whose axis is [feature, coin, time], or out
+        """
+    for feature in features:
+      if feature not in FEATURE_AGGREGATIONS:
+        msg = "The feature %s is not supported" % feature
+        logger.error(msg)
+        raise ValueError(msg)
+
+    if out is not None:
+      shape = (len(features), len(coins), len(self.get_time_axis(start, end, period)))
+      if out.shape != shape:
+        raise ValueError(f"the global data matrix has the shape {shape}, it can not be written into an array of {out.shape}")
       start_timeit = time.time()
-      for feature in features:
-        # NOTE: transform the start date to end date
-        if feature == "close":
-          sql = f"""
-                  SELECT (`date`+300) AS date_norm, close FROM Mkt_History_Px WHERE
-                  (`date`+300)>={start} and (date+300)<={end}
-                  and MOD((`date`+300),{period})=0  and coin='{coin}'
-                """
-        elif feature == "open":
-          sql = f"""
-                  SELECT (`date`+{period}) AS date_norm, open FROM Mkt_History_Px WHERE
-                  (`date`+{period})>={start} and (date+{period})<={end}
-                  and MOD(`date`+{period}),{period})=0 and coin='{coin}'
-                """
-        elif feature == "volume":
-          sql = f"""
-                  SELECT xx.date_norm, SUM(x.volume) as volume 
-                  FROM (
-                      SELECT (`date`+{period})-MOD(`date`,  {period}) AS date_norm, volume, coin 
-                      FROM HisMkt_History_Pxtory
-                  ) xx
-                  WHERE xx.date_norm>={start} 
-                  and xx.date_norm<={end} and xx.coin='{coin}'
-                  GROUP BY xx.date_norm
-                """
-        elif feature == "high":
-          sql = f"""
-                    SELECT xx.date_norm, MAX(xx.high) as high 
-                    FROM (
-                        SELECT (`date`+{period})-MOD(`date`,{period}) AS date_norm, high, coin 
-                        FROM Mkt_History_Px
-                    ) xx
-                    WHERE xx.date_norm>={start} and xx.date_norm<={end} and xx.coin='{coin}'
-                    GROUP BY xx.date_norm
-                """
-        elif feature == "low":
-          sql = f"""
-                    SELECT xx.date_norm, MIN(xx.low) as low FROM 
-                    (
-                      SELECT (`date`+{period})-MOD(`date`,{period}) AS date_norm, low, coin 
-                      FROM Mkt_History_Px
-                    ) xx
-                    WHERE xx.date_norm>={start} and xx.date_norm<={end} and xx.coin='{coin}'
-                    GROUP BY xx.date_norm
-                """
-        else:
-          msg = "The feature %s is not supported" % feature
-          logger.error(msg)
-          raise ValueError(msg)
-        # print(sql)
-        serial_data = db.qry_read_data(sql)
-        # print(type(serial_data))
-        # print(serial_data.dtypes)
-
-        # print(serial_data.head())
-        serial_data['date_norm'] = pd.to_datetime(serial_data['date_norm'], unit='s')
-        # print(serial_data.head())
-        serial_data = serial_data.set_index('date_norm')
-        # print(serial_data.head())
-        serial_data.index.rename("minor", inplace=True)
-        # print(serial_data.head())
-        df_temp = pd.DataFrame(serial_data)
-        # print(df_temp.head())
-        df_temp = df_temp.reset_index()  # move 'minor' to a column which was an index
-        # print(df_temp.head())
-
-        df_temp.insert(loc=0, column="major", value=coin)
-        # print(df_temp.head())
-        df_temp = df_temp.set_index(["major", "minor"])
-        # print(df_temp.head())
-        # print(tabulate(df_temp.head(10), headers='keys', tablefmt='psql'))
-        # print(len(df_temp))
-        # print(tabulate(panel.loc[(coin, slice(None)), [feature]].head(10), headers='keys', tablefmt='psql'))
-        # print(len(panel.loc[(coin, slice(None)), [feature]]))
-
-        panel_section = panel.loc[(coin, slice(None)), [feature]].copy()
-        # print(tabulate(panel_section.head(10), headers='keys', tablefmt='psql'))
-        # print(len(panel_section))
-        panel_section.loc[(coin, slice(None)), [feature]] = df_temp[feature]
-        # print(tabulate(panel_section.head(10), headers='keys', tablefmt='psql'))
-        # print(len(panel_section))
-        # we only want to fill_na on the subsection of the input matrix Xprint(tabulate(panel_section.head(10), headers='keys', tablefmt='psql'))
-        panel_section = panel_fillna(panel_section, "both")
-        # print(len(panel_section))
-        panel.loc[(coin, slice(None)), [feature]] = panel_section
-
-        print(tabulate(panel.query(f'major == "{coin}"').head(10), headers="keys", tablefmt="psql"))
-
-        # print(panel.loc[(slice(None),'minor')>=1439010000, :].head(10))
-
-        # print(panel.loc[("ETH", '2015-05-11 15:00:00'), :].head(10))
-        # print(panel.head(10))
-
-      end_timeit = time.time()
-      logger.info(f">> [{coin}] took: {end_timeit - start_timeit} seconds")
-
-    return panel
+      overflow = False
+      for coin_index, coin in enumerate(coins):
+        out[:, coin_index:coin_index + 1] = self.load_global_array([coin], start, end, period, features, fill_type)
+        overflow = overflow or bool(np.isinf(out[:, coin_index]).any())
+      if overflow:
+        logger.warning(f"some values of the global data overflow {out.dtype}, use a wider storage_dtype")
+      logger.info(f"loaded a {out.shape} {out.dtype} global matrix one coin at a time in {time.time() - start_timeit:.2f} seconds")
+      return out
+
+    start_timeit = time.time()
+    coins_as_str = "'{}'".format("','".join(coins))
+    columns_as_str = ",".join(f"`{feature}`" for feature in features)
+    if period in ROLLUP_PERIODS and self.__rollups_ready:
+      # rollup rows are already aggregated and dated by the end of their bucket
+      sql = f"""
+        SELECT `date` - {period} AS `date`, coin, {columns_as_str} FROM {history_table(period)}
+        WHERE `date` >= {start} AND `date` <= {end}
+        AND coin IN ({coins_as_str})
+      """
+    else:
+      sql = f"""
+        SELECT `date`, coin, {columns_as_str} FROM Mkt_History_Px
+        WHERE `date` >= {start - period} AND `date` <= {end - self.__storage_period}
+        AND coin IN ({coins_as_str})
+      """
+    db = MariaDB()
+    history_df = db.qry_read_data(sql)
+    load_time = time.time() - start_timeit
+
+    global_array = aggregate_candles(dates=history_df["date"].to_numpy(dtype=np.int64),
+                                     coin_indices=pd.Categorical(history_df["coin"], categories=coins).codes,
+                                     values=history_df[list(features)].to_numpy(dtype=np.float64),
+                                     features=features,
+                                     coin_number=len(coins),
+                                     start=start,
+                                     end=end,
+                                     period=period)
+
+    missing = np.isnan(global_array).sum(axis=(0, 2))
+    for coin, missing_count in zip(coins, missing):
+      if missing_count > 0:
+        logger.warning(f"{coin}: {missing_count} values are missing from the data provider" + (" and were back/forward filled" if fill_type else ""))
+    if fill_type:
+      global_array = array_fillna(global_array, fill_type)
+
+    logger.info(f"loaded {len(history_df)} rows into a {global_array.shape} global matrix in {time.time() - start_timeit:.2f} seconds "
+                f"(query: {load_time:.2f} seconds)")
+    return global_array
 
   def select_coins(self, start, end):
     """
@@ -257,14 +418,7 @@ class HistoryManager:
 
       db = MariaDB()
 
-      select_coin_qry = f"""
-          SELECT coin,SUM(volume) AS total_volume, max(date) FROM Mkt_History_Px WHERE
-            date>={int(start)} and date<={int(end)} 
-            GROUP BY coin
-            ORDER BY total_volume DESC 
-            LIMIT {self._coin_number};
-      """
-      # print(select_coin_qry)
+      select_coin_qry = self.__select_coins_qry(int(start), int(end))
       coin_df = db.qry_read_data(select_coin_qry)
 
       if len(coin_df) != self._coin_number:
@@ -282,6 +436,40 @@ class HistoryManager:
 
     return coins
 
+  def __select_coins_qry(self, start: int, end: int) -> str:
+    """
+
+        Builds the query ranking the coins by their total volume of the candles dated in [start, end].
+
+        Whole days are summed from the daily rollup table (one row per coin per day) and only the partial
+        days at both ends of the window are read from the 5 minute candles, so the query scans a few
+        thousand rows instead of every 5 minute candle of the window.
+
+        """
+    # daily rollup rows dated T hold the candles of [T - DAY, T)
+    first_day_start = start + (-start) % DAY
+    last_day_end = (end + self.__storage_period) - (end + self.__storage_period) % DAY
+    if last_day_end - first_day_start < DAY or not self.__rollups_ready:
+      return f"""
+          SELECT coin, SUM(volume) AS total_volume FROM Mkt_History_Px WHERE
+            date>={start} and date<={end}
+            GROUP BY coin
+            ORDER BY total_volume DESC
+            LIMIT {self._coin_number};
+      """
+    return f"""
+        SELECT coin, SUM(volume) AS total_volume FROM (
+            SELECT coin, volume FROM {history_table(DAY)} WHERE date>={first_day_start + DAY} and date<={last_day_end}
+            UNION ALL
+            SELECT coin, volume FROM Mkt_History_Px WHERE date>={start} and date<{first_day_start}
+            UNION ALL
+            SELECT coin, volume FROM Mkt_History_Px WHERE date>={last_day_end} and date<={end}
+        ) window_volume
+        GROUP BY coin
+        ORDER BY total_volume DESC
+        LIMIT {self._coin_number};
+    """
+
   def __checkperiod(self, period):
     if period == FIVE_MINUTES:
       return
@@ -310,88 +498,349 @@ class HistoryManager:
             coin (str): the coin to update
 
         """
-    db = MariaDB()
+    self.update_coins_data(start, end, [coin])
+
+  def update_coins_data(self, start: int, end: int, coins: list):
+    """
+
+        Given a list of coins and start and end timestamp, fill in the missing data of every coin.
+
+        The missing ranges are computed from the coverage index of each coin (see get_coverage), split into
+        three month chunks and all the (coin, chunk) pairs are fetched from the data provider and stored in
+        the DB by a pool of at most max_workers threads. The provider's own rate limiter bounds the number of
+        requests sent per second. Once stored, the fetched chunks are merged into the coverage index.
+
+        Args:
+            start (int): start time timestamp
+            end (int): end time timestamp
+            coins (list): the coins to update
+
+        """
+    start_timeit = time.time()
+    with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+      missing_ranges = list(executor.map(lambda coin: self.__missing_ranges(start, end, coin), coins))
+      chunks = [(chunk_start, chunk_end, coin)
+                for coin, ranges in zip(coins, missing_ranges)
+                for range_start, range_end in ranges
+                for chunk_start, chunk_end in self.__split_into_chunks(range_start, range_end)]
+      if not chunks:
+        return
+      if not self._online:
+        logger.warning(f"{len(chunks)} chunks of data are missing but running offline, nothing will be fetched")
+        return
+
+      logger.info(f"fetching {len(chunks)} chunks for {len(coins)} coins with {self.__max_workers} workers")
+      futures = [executor.submit(self.__fill_part_data, chunk_start, chunk_end, coin) for chunk_start, chunk_end, coin in chunks]
+      stored_ranges = {}
+      fetched_ranges = {}
+      # candles of the last periods may not be published yet, so they are never marked as fetched
+      fetched_limit = int(time.time()) - 2 * self.__storage_period
+      for future in as_completed(futures):
+        # re-raise any exception from the worker
+        stored = future.result()
+        if stored is None:
+          continue
+        coin, chunk_start, chunk_end, stored_start, stored_end = stored
+        if min(chunk_end, fetched_limit) >= chunk_start:
+          fetched_ranges.setdefault(coin, []).append((chunk_start, min(chunk_end, fetched_limit)))
+        if stored_start is not None:
+          previous_start, previous_end = stored_ranges.get(coin, (stored_start, stored_end))
+          stored_ranges[coin] = (min(previous_start, stored_start), max(previous_end, stored_end))
+
+      # one coverage and rollup update per coin, after all its chunks are stored, so that the chunks of a coin never race
+      futures = [executor.submit(self.add_coverage, coin, intervals) for coin, intervals in fetched_ranges.items()]
+      futures += [executor.submit(self.update_rollups, coin, stored_start, stored_end) for coin, (stored_start, stored_end) in stored_ranges.items()]
+      for future in as_completed(futures):
+        future.result()
+    logger.info(f"filled {len(chunks)} chunks in {time.time() - start_timeit:.2f} seconds")
+    logger.info(f"data provider metrics: {self._coin_list.provider.metrics_snapshot()}")
+
+  def __missing_ranges(self, start: int, end: int, coin: str) -> list:
+    """returns the list of (start, end) ranges of the coin that have never been fetched from the data provider
+
+    The ranges are the difference between [start, end] and the coverage intervals of the coin, so holes in
+    the middle of the history are found as well as missing heads and tails.
+    """
     logger.info("update_data: processing coin: " + coin)
+    start = int(start - start % self.__storage_period)
+    end = int(end - end % self.__storage_period)
+    return subtract_intervals(start, end, self.get_coverage(coin), step=self.__storage_period)
 
-    coin_min_max_dates_qry = f"""
-      SELECT coin, MIN(date) as min_date, MAX(date) as max_date FROM Mkt_History_Px 
-      WHERE coin = '{coin}'
+  def get_coverage(self, coin: str) -> list:
     """
-    coin_update_dt_df = db.qry_read_data(coin_min_max_dates_qry)
-    min_date_list = list(coin_update_dt_df.loc[coin_update_dt_df['coin'] == coin, 'min_date'].values)
-    max_date_list = list(coin_update_dt_df.loc[coin_update_dt_df['coin'] == coin, 'max_date'].values)
-
-    # print(type(min_date_list))
-    # print(min_date_list.get('min_date'))
-    # print(min_date_list.values)
-    # print(type(min_date_list.values))
-    # print(list(min_date_list.values))
-    # print(list(min_date_list.values)[0])
-
-    if len(min_date_list) > 0:
-      min_date = min_date_list[0]
-    else:
-      min_date = None
 
-    if len(max_date_list) > 0:
-      max_date = max_date_list[0]
-    else:
-      max_date = None
+        Returns the sorted, disjoint (start, end) intervals of 5 minute candle dates of the coin which have
+        already been fetched from the data provider.
 
-    if min_date == None or max_date == None:
-      self.__fill_data(start, end, coin)
-    else:
-      if max_date + 10 * self.__storage_period < end:
-
-        # removed this part as still want to train even if data right up to end
-        # if not self._online:
-        #   logger.error(
-        #       f"Issue with end date selected. Have to be online. end: {end}, max_date:{max_date}, storage_period:{self.__storage_period}, max_date+10*self.__storage_period: {max_date+10*self.__storage_period}"
-        #   )
-        #   raise Exception("Have to be online")
-        if self._online:
-          self.__fill_data(max_date + self.__storage_period, end, coin)
-      if min_date > start and self._online:
-        self.__fill_data(start, min_date - self.__storage_period - 1, coin)
-
-  def __fill_data(self, start, end, coin):
+        Coins stored before the coverage index existed are seeded once with the contiguous runs of their stored
+        candles, so the holes inside their history are fetched again.
+
+        """
+    db = MariaDB()
+    coverage_df = db.qry_read_data(f"SELECT `start`, `end` FROM Mkt_History_Coverage WHERE coin = '{coin}' ORDER BY `start`")
+    if len(coverage_df) > 0:
+      return [(int(s), int(e)) for s, e in zip(coverage_df["start"], coverage_df["end"])]
+
+    # gaps and islands: the candles of a run without holes share the same slot of the period grid minus row number
+    coin_runs_qry = f"""
+      SELECT MIN(`date`) AS run_start, MAX(`date`) AS run_end FROM (
+        SELECT `date`, CAST(`date` DIV {self.__storage_period} AS SIGNED) - ROW_NUMBER() OVER (ORDER BY `date`) AS run
+        FROM Mkt_History_Px
+        WHERE coin = '{coin}'
+      ) coin_dates
+      GROUP BY run
+      ORDER BY run_start
+    """
+    runs_df = db.qry_read_data(coin_runs_qry)
+    if len(runs_df) == 0:
+      return []
+    coverage = merge_intervals([(int(s), int(e)) for s, e in zip(runs_df["run_start"], runs_df["run_end"])], step=self.__storage_period)
+    self.__store_coverage(coin, coverage)
+    return coverage
+
+  def add_coverage(self, coin: str, intervals: list) -> None:
+    """merges newly fetched (start, end) intervals into the coverage index of the coin"""
+    self.__store_coverage(coin, merge_intervals(self.get_coverage(coin) + list(intervals), step=self.__storage_period))
+
+  @staticmethod
+  def __store_coverage(coin: str, intervals: list) -> None:
+    db = MariaDB()
+    with db.pooled_connection() as connection:
+      with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM Mkt_History_Coverage WHERE coin = %s", (coin,))
+        cursor.executemany("INSERT INTO Mkt_History_Coverage (coin, `start`, `end`) VALUES (%s,%s,%s)", [(coin, s, e) for s, e in intervals])
+      connection.commit()
+
+  @staticmethod
+  def __split_into_chunks(start, end):
     duration = 7819200  # three months
+    chunks = []
     bk_start = start
     for bk_end in range(start + duration - 1, end, duration):
-      self.__fill_part_data(bk_start, bk_end, coin)
+      chunks.append((bk_start, bk_end))
       bk_start += duration
     if bk_start < end:
-      self.__fill_part_data(bk_start, end, coin)
+      chunks.append((bk_start, end))
+    return chunks
 
   def __fill_part_data(self, start, end, coin):
-    db = MariaDB()
-    chart = self._coin_list.get_chart_until_success(pair=self._coin_list.allActiveCoins.at[coin, "pair"], start=start, end=end, period=self.__storage_period)
+    candles = self._coin_list.provider.chartArray(pair=self._coin_list.allActiveCoins.at[coin, "pair"], start=start, end=end, period=self.__storage_period)
     logger.info("fill %s data from %s to %s" %
                 (coin, datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M"), datetime.fromtimestamp(end).strftime("%Y-%m-%d %H:%M")))
-    for c in chart:
-      if c["date"] > 0:
-        if c["weightedAverage"] == 0:
-          weightedAverage = c["close"]
-        else:
-          weightedAverage = c["weightedAverage"]
-
-        # NOTE here the USDT is in reversed order
-        if "reversed_" in coin:
-          input_list = []
-          input_list.append((
-              c["date"],
-              coin,
-              1.0 / c["low"],
-              1.0 / c["high"],
-              1.0 / c["open"],
-              1.0 / c["close"],
-              c["quoteVolume"],
-              c["volume"],
-              1.0 / weightedAverage,
-          ))
-          db.insert_list_data("INSERT INTO Mkt_History_Px VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)", input_list)
-
-        else:
-          input_list = []
-          input_list.append((c["date"], coin, c["high"], c["low"], c["open"], c["close"], c["volume"], c["quoteVolume"], weightedAverage))
-          db.insert_list_data("INSERT INTO Mkt_History_Px VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)", input_list)
+    start_timeit = time.time()
+    dates, values = candles_to_array(candles, reversed_="reversed_" in coin)
+    if len(dates) == 0:
+      logger.info(f"no {coin} candles returned from {start} to {end}")
+      return coin, start, end, None, None
+
+    rows = [(d, coin, *v) for d, v in zip(dates.tolist(), values.tolist())]
+    db = MariaDB()
+    written, isError, errorTxt = db.upsert_list_data("Mkt_History_Px", HISTORY_COLUMNS, rows, batch_size=self.__insert_batch_size)
+    if isError:
+      logger.error(f"failed to store {coin} data from {start} to {end}: {errorTxt}")
+      return None
+    self.record_ingest(coin, start, end, written)
+    elapsed = max(time.time() - start_timeit, 1e-6)
+    logger.info(f"stored {written} {coin} rows in {elapsed:.2f} seconds ({written / elapsed:.0f} rows/s)")
+    return coin, start, end, int(dates.min()), int(dates.max())
+
+  def update_rollups(self, coin: str, start: int, end: int) -> None:
+    """
+
+        Recomputes the rollup candles of every period in ROLLUP_PERIODS affected by the 5 minute candles of coin
+        dated between start and end.
+
+        Every period divides a day, so the whole days around [start, end] are read once from Mkt_History_Px
+        and aggregated to each period in numpy.
+
+        Args:
+            coin (str): the coin whose candles changed
+            start (int): date of the first changed 5 minute candle
+            end (int): date of the last changed 5 minute candle
+
+        """
+    first_candle = int(start - start % DAY)
+    last_candle = int(end - end % DAY + DAY - self.__storage_period)
+    db = MariaDB()
+    candles_df = db.qry_read_data(f"""
+      SELECT `date`, {",".join(f"`{c}`" for c in HISTORY_COLUMNS[2:])} FROM Mkt_History_Px
+      WHERE coin = '{coin}' AND `date` >= {first_candle} AND `date` <= {last_candle}
+    """)
+    if len(candles_df) == 0:
+      return
+
+    dates = candles_df["date"].to_numpy(dtype=np.int64)
+    values = candles_df[list(HISTORY_COLUMNS[2:])].to_numpy(dtype=np.float64)
+    # the weighted average of a rollup is the volume weighted mean of its candles
+    values[:, -1] *= values[:, HISTORY_COLUMNS.index("volume") - 2]
+    for period in ROLLUP_PERIODS:
+      rollup = aggregate_candles(dates=dates,
+                                 coin_indices=np.zeros(len(dates), dtype=np.int64),
+                                 values=values,
+                                 features=HISTORY_COLUMNS[2:],
+                                 coin_number=1,
+                                 start=first_candle + period,
+                                 end=last_candle + self.__storage_period,
+                                 period=period,
+                                 aggregations=ROLLUP_AGGREGATIONS,
+                                 dtype=np.float64)[:, 0, :].T
+      bucket_dates = np.arange(first_candle + period, last_candle + self.__storage_period + 1, period)
+      filled = ~np.isnan(rollup[:, HISTORY_COLUMNS.index("close") - 2])
+      rollup, bucket_dates = rollup[filled], bucket_dates[filled]
+      volume = rollup[:, HISTORY_COLUMNS.index("volume") - 2]
+      close = rollup[:, HISTORY_COLUMNS.index("close") - 2]
+      with np.errstate(divide="ignore", invalid="ignore"):
+        rollup[:, -1] = np.where(volume > 0, rollup[:, -1] / volume, close)
+
+      rows = [(d, coin, *v) for d, v in zip(bucket_dates.tolist(), rollup.tolist())]
+      _, isError, errorTxt = db.upsert_list_data(history_table(period), HISTORY_COLUMNS, rows, batch_size=self.__insert_batch_size)
+      if isError:
+        logger.error(f"failed to update the {period}s rollup of {coin}: {errorTxt}")
+
+  def rebuild_rollups(self, coins: list = None) -> None:
+    """
+
+        Rebuilds the rollup tables from Mkt_History_Px, one three month chunk at a time.
+
+        Args:
+            coins (list, optional): the coins to rebuild. Defaults to every coin in Mkt_History_Px.
+
+        """
+    db = MariaDB()
+    ranges_df = db.qry_read_data("SELECT coin, MIN(date) AS min_date, MAX(date) AS max_date FROM Mkt_History_Px GROUP BY coin")
+    if coins is not None:
+      ranges_df = ranges_df[ranges_df["coin"].isin(coins)]
+    logger.info(f"rebuilding the rollup tables of {len(ranges_df)} coins")
+    jobs = [(coin, chunk_start, chunk_end)
+            for coin, min_date, max_date in zip(ranges_df["coin"], ranges_df["min_date"], ranges_df["max_date"])
+            for chunk_start, chunk_end in self.__split_into_chunks(int(min_date), int(max_date))]
+    with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+      for future in as_completed([executor.submit(self.update_rollups, coin, chunk_start, chunk_end) for coin, chunk_start, chunk_end in jobs]):
+        future.result()
+
+
+def history_table(period: int) -> str:
+  """returns the table holding the candles of period: Mkt_History_Px for 5 minutes, Mkt_History_Px_<period> for a rollup
+
+  Rows of a rollup table are dated by the end of their bucket, rows of Mkt_History_Px by the start of their candle.
+  """
+  period = int(period)
+  if period == FIVE_MINUTES:
+    return "Mkt_History_Px"
+  if period not in ROLLUP_PERIODS:
+    raise ValueError(f"there is no history table for period {period}")
+  return f"Mkt_History_Px_{period}"
+
+
+def aggregate_candles(dates: np.ndarray,
+                      coin_indices: np.ndarray,
+                      values: np.ndarray,
+                      features: tuple,
+                      coin_number: int,
+                      start: int,
+                      end: int,
+                      period: int,
+                      aggregations: tuple = None,
+                      dtype=np.float32) -> np.ndarray:
+  """Aggregates 5 minute candles of several coins into a [feature, coin, time] array
+
+  The candle dated d is put in the bucket ending at T = d - d % period + period, and the buckets are aggregated
+  according to FEATURE_AGGREGATIONS (last close, first open, max high, min low, summed volume).
+  Buckets without any candle are left as nan.
+
+  Args:
+      dates (np.ndarray): [n] candle timestamps
+      coin_indices (np.ndarray): [n] position of the coin of each candle on the coin axis, negative to ignore the candle
+      values (np.ndarray): [n, len(features)] candle values
+      features (tuple): the feature name of each column of values
+      coin_number (int): the size of the coin axis
+      start (int): timestamp of the first bucket, aligned to period
+      end (int): timestamp of the last bucket, aligned to period
+      period (int): the bucket size in seconds
+      aggregations (tuple, optional): the aggregation (last, first, max, min or sum) of each column of values.
+          Defaults to the FEATURE_AGGREGATIONS of features.
+      dtype (optional): the dtype of the result, the buckets are aggregated in the dtype of values. Defaults to np.float32.
+
+  Returns:
+      np.ndarray: array of dtype whose axis is [feature, coin, time]
+  """
+  if aggregations is None:
+    aggregations = [FEATURE_AGGREGATIONS[feature] for feature in features]
+  period_number = (end - start) // period + 1
+  result = np.full((len(features), coin_number, period_number), np.nan, dtype=dtype)
+
+  time_indices = (dates - dates % period + period - start) // period
+  valid = (time_indices >= 0) & (time_indices < period_number) & (coin_indices >= 0)
+  if not valid.any():
+    return result
+  keys = coin_indices[valid].astype(np.int64) * period_number + time_indices[valid]
+  order = np.lexsort((dates[valid], keys))
+  keys = keys[order]
+  values = values[valid][order]
+
+  # the candles of each (coin, time) bucket are now contiguous and sorted by date
+  group_starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+  group_ends = np.r_[group_starts[1:], len(keys)] - 1
+  group_coins, group_times = np.divmod(keys[group_starts], period_number)
+
+  for feature_index, aggregation in enumerate(aggregations):
+    column = values[:, feature_index]
+    if aggregation == "last":
+      aggregated = column[group_ends]
+    elif aggregation == "first":
+      aggregated = column[group_starts]
+    elif aggregation == "max":
+      aggregated = np.fmax.reduceat(column, group_starts)
+    elif aggregation == "min":
+      aggregated = np.fmin.reduceat(column, group_starts)
+    else:
+      aggregated = np.add.reduceat(np.nan_to_num(column), group_starts)
+    result[feature_index, group_coins, group_times] = aggregated
+  return result
+
+
+def chart_to_array(chart: list, reversed_: bool = False):
+  """Converts a chart returned by returnChartData into arrays ready to be stored in Mkt_History_Px, see candles_to_array
+
+  Args:
+      chart (list): list of candle dictionaries as returned by returnChartData
+      reversed_ (bool, optional): True if the coin is quoted in reversed order. Defaults to False.
+  """
+  if len(chart) == 0:
+    return candles_to_array(np.empty((0, len(CHART_COLUMNS))), reversed_)
+  return candles_to_array(np.array([[c[column] for column in CHART_COLUMNS] for c in chart], dtype=np.float64), reversed_)
+
+
+def candles_to_array(candles: np.ndarray, reversed_: bool = False):
+  """Converts candles returned by DataProvider.chartArray into arrays ready to be stored in Mkt_History_Px
+
+  The conversion is done in a single vectorized pass over the whole chart.
+  For reversed pairs (e.g. USDT_BTC) prices are inverted, high/low are swapped and volume/quoteVolume are swapped.
+  Candles with a non positive date or with a non finite price after conversion are dropped.
+
+  Args:
+      candles (np.ndarray): float array of shape [n, len(CHART_COLUMNS)]
+      reversed_ (bool, optional): True if the coin is quoted in reversed order. Defaults to False.
+
+  Returns:
+      tuple: (dates, values) where dates is an int64 array of shape [n] and values a float64 array of shape [n, 7]
+      whose columns are HISTORY_COLUMNS[2:]
+  """
+  if len(candles) == 0:
+    return np.empty(0, dtype=np.int64), np.empty((0, len(CHART_COLUMNS) - 1))
+
+  raw = np.asarray(candles, dtype=np.float64)
+  raw = raw[raw[:, 0] > 0]
+  date, high, low, open_, close, volume, quote_volume, weighted_average = raw.T
+  weighted_average = np.where(weighted_average == 0, close, weighted_average)
+
+  if reversed_:
+    with np.errstate(divide="ignore"):
+      values = np.column_stack((1.0 / low, 1.0 / high, 1.0 / open_, 1.0 / close, quote_volume, volume, 1.0 / weighted_average))
+  else:
+    values = np.column_stack((high, low, open_, close, volume, quote_volume, weighted_average))
+
+  valid = np.isfinite(values).all(axis=1)
+  if not valid.all():
+    logger.warning(f"dropping {int((~valid).sum())} candles with non finite values")
+  return date[valid].astype(np.int64), values[valid]
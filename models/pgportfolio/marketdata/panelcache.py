@@ -0,0 +1,153 @@
+from __future__ import absolute_import, division, print_function
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from models.pgportfolio.constants import DATABASE_DIR
+from common.custom_logger2 import get_custom_logger
+
+logger = get_custom_logger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.normpath(DATABASE_DIR)), "panel_cache")
+DEFAULT_CACHE_SIZE_MB = 2048
+
+
+class PanelCache:
+  """
+
+    Content addressed on-disk cache of global data matrices.
+
+    Each entry is stored as two files named after its key:
+        <key>.npy       the [feature, coin, time] array, loaded memory mapped
+        <key>.axes.npz  the coin and time axes of the array
+
+    The key is a hash of everything the matrix depends on, including a data version of the history table,
+    so an entry is never invalidated explicitly: new history rows produce a new key and the old entry is
+    eventually evicted. Eviction is least recently used, bounded by the total size of the cache directory.
+
+    Args:
+        cache_dir (str, optional): the directory holding the cache files. Defaults to DEFAULT_CACHE_DIR.
+        max_size_mb (float, optional): the maximum total size of the cache. Defaults to DEFAULT_CACHE_SIZE_MB.
+    """
+
+  _lock = threading.Lock()
+
+  def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_size_mb: float = DEFAULT_CACHE_SIZE_MB):
+    self._cache_dir = cache_dir
+    self._max_bytes = int(max_size_mb * 1024 * 1024)
+    os.makedirs(self._cache_dir, exist_ok=True)
+
+  @staticmethod
+  def make_key(coins: list, start: int, end: int, period: int, features: tuple, data_version) -> str:
+    """returns the cache key of a global data matrix
+
+    Args:
+        coins (list): the coins of the coin axis, in order
+        start (int): the first timestamp of the time axis
+        end (int): the last timestamp of the time axis
+        period (int): the period of the time axis
+        features (tuple): the features of the feature axis, in order
+        data_version: any json serializable value which changes whenever the underlying history changes
+
+    Returns:
+        str: the hex digest identifying the matrix
+    """
+    description = json.dumps(
+        {
+            "coins": list(coins),
+            "start": int(start),
+            "end": int(end),
+            "period": int(period),
+            "features": list(features),
+            "data_version": data_version,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+  def _array_path(self, key: str) -> str:
+    return os.path.join(self._cache_dir, key + ".npy")
+
+  def _axes_path(self, key: str) -> str:
+    return os.path.join(self._cache_dir, key + ".axes.npz")
+
+  def load(self, key: str):
+    """returns the cached entry of key or None
+
+    Returns:
+        tuple: (array, coins, time_axis) where array is a read only memory map, or None if key is not cached
+    """
+    array_path = self._array_path(key)
+    axes_path = self._axes_path(key)
+    if not (os.path.isfile(array_path) and os.path.isfile(axes_path)):
+      return None
+    try:
+      array = np.load(array_path, mmap_mode="r")
+      with np.load(axes_path) as axes:
+        coins = axes["coins"].tolist()
+        time_axis = axes["time_axis"]
+    except (OSError, ValueError) as e:
+      logger.warning(f"ignoring unreadable panel cache entry {key}: {e}")
+      return None
+    # refresh the access time used by the LRU eviction
+    os.utime(array_path)
+    logger.info(f"panel cache hit: {key} {array.shape}")
+    return array, coins, time_axis
+
+  def store(self, key: str, array: np.ndarray, coins: list, time_axis: np.ndarray) -> None:
+    """writes an entry to the cache and evicts the least recently used entries above the size limit
+
+    Files are written under a temporary name then renamed so readers never see a partial entry.
+    """
+    array_path = self._array_path(key)
+    axes_path = self._axes_path(key)
+    tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(axes_path + tmp_suffix, "wb") as f:
+      np.savez(f, coins=np.array(coins), time_axis=time_axis)
+    with open(array_path + tmp_suffix, "wb") as f:
+      np.save(f, np.ascontiguousarray(array))
+    # the axes are renamed first as an entry only exists once its array file exists
+    os.replace(axes_path + tmp_suffix, axes_path)
+    os.replace(array_path + tmp_suffix, array_path)
+    logger.info(f"panel cache store: {key} {array.shape}")
+    self.evict(keep=key)
+
+  def evict(self, keep: str = None) -> None:
+    """removes least recently used entries until the cache fits in max_size_mb
+
+    Args:
+        keep (str, optional): a key which is never evicted, e.g. the entry just stored. Defaults to None.
+    """
+    with PanelCache._lock:
+      entries = []
+      total_bytes = 0
+      for filename in os.listdir(self._cache_dir):
+        if not filename.endswith(".npy"):
+          continue
+        key = filename[:-len(".npy")]
+        if key == keep:
+          continue
+        try:
+          array_stat = os.stat(self._array_path(key))
+          axes_size = os.path.getsize(self._axes_path(key)) if os.path.isfile(self._axes_path(key)) else 0
+        except OSError:
+          continue
+        size = array_stat.st_size + axes_size
+        entries.append((array_stat.st_mtime, key, size))
+        total_bytes += size
+      if keep is not None and os.path.isfile(self._array_path(keep)):
+        total_bytes += os.path.getsize(self._array_path(keep))
+
+      entries.sort()
+      while total_bytes > self._max_bytes and entries:
+        _, key, size = entries.pop(0)
+        for path in (self._array_path(key), self._axes_path(key)):
+          try:
+            os.remove(path)
+          except OSError:
+            pass
+        total_bytes -= size
+        logger.info(f"panel cache evicted: {key}")
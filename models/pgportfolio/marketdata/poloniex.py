@@ -1,14 +1,14 @@
 import json
 import time
-import sys
+import random
+import queue
+import threading
+import http.client
+from collections import deque
 from datetime import datetime
-
-if sys.version_info[0] == 3:
-    from urllib.request import Request, urlopen
-    from urllib.parse import urlencode
-else:
-    from urllib2 import Request, urlopen
-    from urllib import urlencode
+from urllib.parse import urlencode, urlsplit
+from models.pgportfolio.tools.ratelimit import TokenBucket
+from models.pgportfolio.marketdata.provider import DataProvider, POLONIEX
 
 minute = 60
 hour = minute*60
@@ -20,10 +20,95 @@ year = day*365
 # Possible Commands
 PUBLIC_COMMANDS = ['returnTicker', 'return24hVolume', 'returnOrderBook', 'returnTradeHistory', 'returnChartData', 'returnCurrencies', 'returnLoanOrders']
 
-class Poloniex:
-    def __init__(self, APIKey='', Secret=''):
+PUBLIC_URL = 'https://poloniex.com/public'
+# public API limit published by Poloniex
+DEFAULT_REQUESTS_PER_SECOND = 6
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_POOL_SIZE = 8
+# exponential backoff: the n-th retry waits a random time in [0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** n)]
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+# HTTP statuses worth retrying, anything else is returned to the caller as is
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class PoloniexError(Exception):
+    """raised when a request still fails after the retry budget is exhausted"""
+
+
+class ClientMetrics:
+    """thread safe request latency and retry counters of a Poloniex client"""
+
+    def __init__(self, latency_window=1000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=latency_window)
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.rate_limited_seconds = 0.0
+
+    def record_request(self, latency):
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(latency)
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    def record_rate_limit_wait(self, seconds):
+        with self._lock:
+            self.rate_limited_seconds += seconds
+
+    def snapshot(self):
+        """returns the counters and the latency statistics (in seconds) of the recent requests as a dict"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            result = {
+                'requests': self.requests,
+                'retries': self.retries,
+                'failures': self.failures,
+                'rate_limited_seconds': self.rate_limited_seconds,
+            }
+        if latencies:
+            result['latency_mean'] = sum(latencies) / len(latencies)
+            result['latency_p50'] = latencies[len(latencies) // 2]
+            result['latency_p95'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            result['latency_max'] = latencies[-1]
+        return result
+
+
+class Poloniex(DataProvider):
+    """
+    Client of the Poloniex public API, the default DataProvider.
+
+    Connections are kept alive and reused from a small pool, requests are throttled by a token bucket shared
+    by all the threads using the instance, and failed requests (network errors, timeouts, 429/5xx, invalid
+    json) are retried with exponential backoff and full jitter until max_retries is exhausted.
+
+    base_url can point to a local stand-in server, e.g. 'http://127.0.0.1:8000/public', for testing.
+    """
+    name = POLONIEX
+
+    def __init__(self, APIKey='', Secret='', requests_per_second=DEFAULT_REQUESTS_PER_SECOND, base_url=PUBLIC_URL, timeout=DEFAULT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, pool_size=DEFAULT_POOL_SIZE):
         self.APIKey = APIKey.encode()
         self.Secret = Secret.encode()
+        # shared by every thread using this provider instance
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.metrics = ClientMetrics()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        url = urlsplit(base_url)
+        self._scheme = url.scheme
+        self._host = url.netloc
+        self._path = url.path or '/'
+        self._connections = queue.LifoQueue(maxsize=pool_size)
         # Conversions
         self.timestamp_str = lambda timestamp=time.time(), format="%Y-%m-%d %H:%M:%S": datetime.fromtimestamp(timestamp).strftime(format)
         self.str_timestamp = lambda datestr=self.timestamp_str(), format="%Y-%m-%d %H:%M:%S": int(time.mktime(time.strptime(datestr, format)))
@@ -39,6 +124,12 @@ class Poloniex:
         self.marketChart = lambda pair, period=day, start=time.time()-(week*1), end=time.time(): self.api('returnChartData', {'currencyPair':pair, 'period':period, 'start':start, 'end':end})
         self.marketTradeHist = lambda pair: self.api('returnTradeHistory',{'currencyPair':pair}) # NEEDS TO BE FIXED ON Poloniex
 
+    def activePairs(self):
+        return [pair for pair, ticker in self.marketTicker().items() if str(ticker.get('isFrozen', '0')) == '0']
+
+    def metrics_snapshot(self):
+        return self.metrics.snapshot()
+
     #####################
     # Main Api Function #
     #####################
@@ -46,11 +137,69 @@ class Poloniex:
         """
         returns 'False' if invalid command or if no APIKey or Secret is specified (if command is "private")
         returns {"error":"<error message>"} if API error
+        raises PoloniexError if the request could not be completed within the retry budget
         """
         if command in PUBLIC_COMMANDS:
-            url = 'https://poloniex.com/public?'
+            # copy so that concurrent calls never share the mutable default
+            args = dict(args)
             args['command'] = command
-            ret = urlopen(Request(url + urlencode(args)))
-            return json.loads(ret.read().decode(encoding='UTF-8'))
+            return self._get(self._path + '?' + urlencode(args))
         else:
             return False
+
+    def _get(self, path):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.metrics.record_retry()
+                time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1))))
+            self.metrics.record_rate_limit_wait(self.rate_limiter.acquire())
+            connection = self._get_connection()
+            request_start = time.monotonic()
+            try:
+                connection.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                # the connection is in an unknown state, drop it
+                connection.close()
+                last_error = e
+                continue
+            self.metrics.record_request(time.monotonic() - request_start)
+            if response.will_close:
+                connection.close()
+            else:
+                self._release_connection(connection)
+
+            if response.status in RETRY_STATUSES:
+                last_error = PoloniexError('HTTP %s: %s' % (response.status, body[:200]))
+                continue
+            try:
+                return json.loads(body.decode(encoding='UTF-8'))
+            except ValueError as e:
+                last_error = e
+                continue
+        self.metrics.record_failure()
+        raise PoloniexError('request %s failed after %s retries: %s' % (path, self.max_retries, last_error))
+
+    def _get_connection(self):
+        try:
+            return self._connections.get_nowait()
+        except queue.Empty:
+            if self._scheme == 'http':
+                return http.client.HTTPConnection(self._host, timeout=self.timeout)
+            return http.client.HTTPSConnection(self._host, timeout=self.timeout)
+
+    def _release_connection(self, connection):
+        try:
+            self._connections.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        """closes all the pooled connections"""
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                return
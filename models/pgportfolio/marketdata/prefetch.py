@@ -0,0 +1,78 @@
+from __future__ import absolute_import, division, print_function
+import queue
+import threading
+
+from common.custom_logger2 import get_custom_logger
+
+logger = get_custom_logger(__name__)
+
+# last_w is read from the portfolio vector memory when the batch is handed over, after the previous batch wrote it back
+EXACT = "exact"
+# last_w is read when the batch is built, so it misses the writes of the at most `depth` batches still in flight
+STALE = "stale"
+PREFETCH_MODES = (EXACT, STALE)
+
+
+class BatchPrefetcher:
+  """
+
+    Builds the next training batches of a DataMatrices in a background thread while the current batch is trained.
+
+    The producer samples the replay buffer and gathers X and y, which do not depend on the training, into a queue
+    of at most depth batches. The portfolio vector memory (PVM) is the only state shared with the training loop:
+    setw writes the output weights of a batch which later batches read as last_w. In EXACT mode last_w is read by
+    get() in the calling thread, after the previous batch was written back, so the batches are identical to the
+    ones built without prefetching. In STALE mode last_w is read by the producer as well, which saves that read on
+    the training thread but may miss the weights written by the batches still in the queue.
+
+    The replay buffer must not be appended to while the prefetcher runs.
+
+    Args:
+        matrices (DataMatrices): the data matrices to take the batches from
+        depth (int, optional): the maximum number of batches built ahead. Defaults to 2.
+        mode (str, optional): EXACT or STALE. Defaults to EXACT.
+    """
+
+  def __init__(self, matrices, depth: int = 2, mode: str = EXACT):
+    if mode not in PREFETCH_MODES:
+      raise ValueError("prefetch mode must be one of {}, not {}".format(PREFETCH_MODES, mode))
+    self._matrices = matrices
+    self._mode = mode
+    self._queue = queue.Queue(maxsize=max(1, int(depth)))
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._produce, name="batch-prefetcher", daemon=True)
+    self._thread.start()
+    logger.info(f"prefetching {self._queue.maxsize} batches in {mode} mode")
+
+  def _produce(self):
+    try:
+      while not self._stop.is_set():
+        batch = self._matrices.next_batch(with_last_w=self._mode == STALE)
+        while not self._stop.is_set():
+          try:
+            self._queue.put(batch, timeout=0.1)
+            break
+          except queue.Full:
+            continue
+    except BaseException as e:
+      # handed over to the training thread, which re-raises it
+      self._queue.put(e)
+
+  def get(self) -> dict:
+    """returns the next batch, in the format of DataMatrices.next_batch"""
+    batch = self._queue.get()
+    if isinstance(batch, BaseException):
+      raise batch
+    if batch["last_w"] is None:
+      batch["last_w"] = self._matrices.read_last_w(batch["indexs"])
+    return batch
+
+  def close(self) -> None:
+    """stops the producer and drops the batches built ahead"""
+    self._stop.set()
+    while self._thread.is_alive():
+      try:
+        self._queue.get_nowait()
+      except queue.Empty:
+        pass
+      self._thread.join(timeout=0.1)
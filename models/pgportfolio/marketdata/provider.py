@@ -0,0 +1,81 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+
+# fields of a returnChartData candle, in the order of the rows returned by DataProvider.chartArray
+CHART_COLUMNS = ("date", "high", "low", "open", "close", "volume", "quoteVolume", "weightedAverage")
+
+POLONIEX = "POLONIEX"
+FILE = "FILE"
+
+
+class DataProvider:
+  """
+
+    Interface of the market data sources used by CoinList and HistoryManager.
+
+    The methods and the shape of their results follow the Poloniex public API, so that the Poloniex client is
+    a provider as is:
+        marketVolume()  {pair: {currency: volume, ...}} of the last 24 hours
+        marketTicker()  {pair: {"last": price, ...}}
+        marketChart()   list of candle dicts with the CHART_COLUMNS fields, dated by the start of the candle
+        activePairs()   list of the pairs that can be traded
+
+    Pairs are named "<base>_<quote>", e.g. BTC_ETH.
+    """
+
+  name = ""
+
+  def marketVolume(self) -> dict:
+    raise NotImplementedError()
+
+  def marketTicker(self) -> dict:
+    raise NotImplementedError()
+
+  def marketChart(self, pair: str, period: int, start: int, end: int) -> list:
+    raise NotImplementedError()
+
+  def activePairs(self) -> list:
+    raise NotImplementedError()
+
+  def chartArray(self, pair: str, period: int, start: int, end: int) -> np.ndarray:
+    """returns the candles of marketChart as a float64 array of shape [n, len(CHART_COLUMNS)]
+
+    Providers which do not hold the candles as dicts should override it to skip the conversion.
+    """
+    chart = self.marketChart(pair=pair, period=int(period), start=int(start), end=int(end))
+    if len(chart) == 0:
+      return np.empty((0, len(CHART_COLUMNS)))
+    return np.array([[candle[column] for column in CHART_COLUMNS] for candle in chart], dtype=np.float64)
+
+  def metrics_snapshot(self) -> dict:
+    """returns statistics about the requests served by the provider, if any"""
+    return {}
+
+  def close(self) -> None:
+    pass
+
+
+def create_provider(data_provider: str = POLONIEX, data_dir: str = None, **kwargs) -> DataProvider:
+  """creates the data provider named in the input config
+
+  Args:
+      data_provider (str, optional): POLONIEX or FILE, an empty name means POLONIEX. Defaults to POLONIEX.
+      data_dir (str, optional): the directory of the candle archives replayed by the FILE provider. Defaults to None.
+      **kwargs: passed to the constructor of the Poloniex client, e.g. requests_per_second
+
+  Raises:
+      ValueError: if the provider is unknown or data_dir is missing for the FILE provider
+
+  Returns:
+      DataProvider: the provider
+  """
+  name = (data_provider or POLONIEX).upper()
+  if name == POLONIEX:
+    from models.pgportfolio.marketdata.poloniex import Poloniex
+    return Poloniex(**kwargs)
+  if name == FILE:
+    if not data_dir:
+      raise ValueError("the FILE data provider needs input.data_dir")
+    from models.pgportfolio.marketdata.filereplay import FileReplayProvider
+    return FileReplayProvider(data_dir)
+  raise ValueError("market {} is not valid".format(data_provider))
@@ -11,49 +11,63 @@ class ReplayBuffer:
         :param end_index: end index of the training set on the global data matrices
         """
     self.__coin_number = coin_number
-    self.__experiences = [Experience(i) for i in range(start_index, end_index)]
+    # state indexes of the experiences, only the first __size entries are used
+    self.__size = max(0, int(end_index) - int(start_index))
+    self.__state_indexes = np.arange(start_index, start_index + max(self.__size, 1), dtype=np.int64)
     self.__is_permed = is_permed
     # NOTE: in order to achieve the previous w feature
     self.__batch_size = batch_size
     self.__sample_bias = sample_bias
     logging.debug("buffer_bias is %f" % sample_bias)
 
+  def __len__(self):
+    return self.__size
+
+  @property
+  def state_indexes(self):
+    return self.__state_indexes[:self.__size]
+
   def append_experience(self, state_index):
-    self.__experiences.append(Experience(state_index))
-    # print(type(state_index))
-    # print(state_index.item())
-    # print(type(state_index.item()))
-    # print(state_index.tolist())
-    # print(str(state_index))
-    new_exp_str = str(state_index.item())
-    print(f"a new experience, indexed by {new_exp_str} was appended")
-    #logging.debug(f"a new experience, indexed by {state_index.tolist()} was appended")
-
-  def __sample(self, start, end, bias):
+    if self.__size == len(self.__state_indexes):
+      # amortized O(1) appends
+      grown = np.empty(2 * len(self.__state_indexes), dtype=np.int64)
+      grown[:self.__size] = self.__state_indexes[:self.__size]
+      self.__state_indexes = grown
+    self.__state_indexes[self.__size] = int(state_index)
+    self.__size += 1
+    logging.debug("a new experience, indexed by %d was appended" % int(state_index))
+
+  @staticmethod
+  def sample(start, end, bias, size=None):
     """
+        draws from the geometric distribution of parameter bias truncated to [start, end), the most likely value
+        being end - 1, by inverting its cumulative distribution function
         @:param end: is excluded
-        @:param bias: value in (0, 1)
+        @:param bias: value in [0, 1], 0 samples uniformly
+        @:param size: the number of samples, None for a scalar
         """
-    # TODO: deal with the case when bias is 0
-    ran = np.random.geometric(bias)
-    while ran > end - start:
-      ran = np.random.geometric(bias)
-    result = end - ran
-    return result
+    count = end - start
+    if count < 1:
+      raise ValueError("can not sample from an empty range [%d, %d)" % (start, end))
+    u = np.random.random_sample(size)
+    if bias <= 0:
+      ran = np.floor(u * count) + 1
+    elif bias >= 1:
+      ran = np.ones_like(u)
+    else:
+      log_q = np.log1p(-bias)
+      # P(ran <= k) = (1 - q ** k) / (1 - q ** count) with q = 1 - bias
+      ran = np.ceil(np.log1p(u * np.expm1(count * log_q)) / log_q)
+    ran = np.clip(ran, 1, count).astype(np.int64)
+    return end - ran
 
   def next_experience_batch(self):
-    # First get a start point randomly
-    batch = []
+    """
+        @:return: the state indexes of the next batch, an int64 array of shape [batch_size]
+        """
     if self.__is_permed:
-      for i in range(self.__batch_size):
-        batch.append(self.__experiences[self.__sample(self.__experiences[0].state_index, self.__experiences[-1].state_index, self.__sample_bias)])
-    else:
-      batch_start = self.__sample(0, len(self.__experiences) - self.__batch_size, self.__sample_bias)
-      batch = self.__experiences[batch_start:batch_start + self.__batch_size]
-    return batch
-
-
-class Experience:
-
-  def __init__(self, state_index):
-    self.state_index = int(state_index)
+      positions = self.sample(0, self.__size - 1, self.__sample_bias, size=self.__batch_size)
+      return self.__state_indexes[positions]
+    # First get a start point randomly
+    batch_start = int(self.sample(0, self.__size - self.__batch_size, self.__sample_bias))
+    return self.__state_indexes[batch_start:batch_start + self.__batch_size].copy()
@@ -0,0 +1,101 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+
+from models.pgportfolio.constants import DAY, YEAR
+
+from common.custom_logger2 import get_custom_logger
+
+logger = get_custom_logger(__name__)
+
+# number of coins generated at once, bounds the size of the float64 temporaries
+COIN_BLOCK = 4
+
+
+def fake_coins(coin_number: int) -> list:
+  """returns the names of the synthetic coins"""
+  return ["FAKE%03d" % i for i in range(coin_number)]
+
+
+def generate_global_array(coin_number: int,
+                          periods: int,
+                          features=("close", "high", "low"),
+                          period: int = 1800,
+                          seed: int = 0,
+                          annual_drift: float = 0.0,
+                          annual_volatility: float = 0.8,
+                          correlation: float = 0.5,
+                          jump_rate: float = 1e-3,
+                          jump_std: float = 0.05,
+                          regime_switch_rate: float = 1e-3,
+                          turbulent_volatility: float = 2.5,
+                          out: np.ndarray = None) -> np.ndarray:
+  """
+
+    Generates a synthetic market as a [feature, coin, time] float32 array, in the layout of
+    HistoryManager.get_global_data_matrix, without any database.
+
+    Closes follow a geometric brownian motion per coin whose shocks share a common market factor (one factor
+    correlation model), with normally distributed jumps and a calm/turbulent volatility regime which switches with
+    probability regime_switch_rate each period. Open is the previous close, high/low extend the open/close range by
+    a half normal fraction of the period volatility and the volume grows with the absolute return.
+
+    Args:
+        coin_number (int): the number of coins
+        periods (int): the number of periods
+        features (tuple, optional): any of close, high, low, open, volume. Defaults to ("close", "high", "low").
+        period (int, optional): the length of a period in seconds. Defaults to 1800.
+        seed (int, optional): the seed of the generator, the same seed gives the same market. Defaults to 0.
+        annual_drift (float, optional): the mean annual log return. Defaults to 0.0.
+        annual_volatility (float, optional): the median annual volatility of the coins. Defaults to 0.8.
+        correlation (float, optional): the correlation of the shocks of two coins, in [0, 1]. Defaults to 0.5.
+        jump_rate (float, optional): the probability of a jump per coin and period. Defaults to 1e-3.
+        jump_std (float, optional): the standard deviation of the log size of the jumps. Defaults to 0.05.
+        regime_switch_rate (float, optional): the probability of a regime switch per period. Defaults to 1e-3.
+        turbulent_volatility (float, optional): the volatility multiplier of the turbulent regime. Defaults to 2.5.
+        out (np.ndarray, optional): a float32 array of shape [len(features), coin_number, periods] to write into,
+            e.g. a memory map. Defaults to None.
+
+    Returns:
+        np.ndarray: the global data array
+    """
+  rng = np.random.default_rng(seed)
+  dt = period / YEAR
+  shape = (len(features), coin_number, periods)
+  result = np.empty(shape, dtype=np.float32) if out is None else out
+  if result.shape != shape:
+    raise ValueError("out has shape {}, expected {}".format(result.shape, shape))
+
+  # shared by every coin: the volatility regime and the market factor
+  regime = np.cumsum(rng.random(periods) < regime_switch_rate) % 2
+  volatility_multiplier = np.where(regime == 1, turbulent_volatility, 1.0)
+  market_shock = rng.standard_normal(periods)
+
+  # per coin: volatility, initial price and volume level
+  coin_volatility = annual_volatility * np.exp(rng.normal(0.0, 0.3, coin_number))
+  initial_price = np.exp(rng.uniform(np.log(1e-5), np.log(0.1), coin_number))
+  volume_level = np.exp(rng.normal(np.log(50.0), 1.0, coin_number)) * period / DAY
+
+  for block_start in range(0, coin_number, COIN_BLOCK):
+    block = slice(block_start, min(block_start + COIN_BLOCK, coin_number))
+    n = block.stop - block.start
+    sigma = coin_volatility[block, None] * volatility_multiplier[None, :] * np.sqrt(dt)
+    shock = np.sqrt(correlation) * market_shock[None, :] + np.sqrt(1.0 - correlation) * rng.standard_normal((n, periods))
+    jumps = (rng.random((n, periods)) < jump_rate) * rng.normal(0.0, jump_std, (n, periods))
+    log_return = (annual_drift * dt - 0.5 * sigma**2) + sigma * shock + jumps
+
+    close = initial_price[block, None] * np.exp(np.cumsum(log_return, axis=1))
+    open_ = np.concatenate((initial_price[block, None], close[:, :-1]), axis=1)
+    values = {"close": close, "open": open_}
+    if "high" in features:
+      values["high"] = np.maximum(open_, close) * np.exp(np.abs(rng.standard_normal((n, periods))) * 0.5 * sigma)
+    if "low" in features:
+      values["low"] = np.minimum(open_, close) * np.exp(-np.abs(rng.standard_normal((n, periods))) * 0.5 * sigma)
+    if "volume" in features:
+      values["volume"] = volume_level[block, None] * np.exp(rng.normal(0.0, 0.5, (n, periods))) * (1.0 + np.abs(log_return) / sigma)
+    for feature_index, feature in enumerate(features):
+      if feature not in values:
+        raise ValueError("unknown synthetic feature {}".format(feature))
+      result[feature_index, block] = values[feature]
+
+  logger.info(f"generated a synthetic market of {coin_number} coins and {periods} periods, seed {seed}")
+  return result
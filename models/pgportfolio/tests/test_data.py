@@ -0,0 +1,87 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pytest
+
+from models.pgportfolio.tools.data import pricenorm, pricenorm2d, pricenorm3d
+
+FEATURES = ["close", "high", "low"]
+NORM_METHODS = ["absolute", "relative"]
+FAKE_RATIOS = [1.0, 1.01]
+# number of random tensors compared to the reference per combination of parameters
+TRIALS = 400
+
+
+def pricenorm3d_reference(m, features, norm_method, fake_ratio=1.0, with_y=True):
+    """the feature by feature implementation of pricenorm3d, calling pricenorm2d on a copy of every feature"""
+    result = m.copy()
+    one_position = 2 if with_y else 1
+    for i in range(len(features)):
+        pricenorm2d(result[i], m[0, :, -one_position], norm_method=norm_method, fake_ratio=fake_ratio, one_position=one_position)
+    return result
+
+
+def random_tensor(rng, shape):
+    """prices with nan at random, and coins without a reference close"""
+    m = rng.uniform(0.5, 2.0, shape)
+    m[rng.random(shape) < rng.uniform(0.0, 0.6)] = np.nan
+    # the close used as reference by the absolute norm, at -2 with y and -1 without
+    for position in (-2, -1):
+        m[..., 0, rng.random(shape[-2]) < 0.3, position] = np.nan
+    return m
+
+
+def assert_same(expected, actual, fake_ratio):
+    assert actual.shape == expected.shape
+    assert np.array_equal(np.isnan(actual), np.isnan(expected))
+    if fake_ratio == 1.0:
+        np.testing.assert_array_equal(actual, expected)
+    else:
+        np.testing.assert_allclose(actual, expected, rtol=1e-12, equal_nan=True)
+
+
+@pytest.mark.parametrize("norm_method", NORM_METHODS)
+@pytest.mark.parametrize("with_y", [True, False])
+@pytest.mark.parametrize("fake_ratio", FAKE_RATIOS)
+def test_pricenorm_matches_pricenorm2d(norm_method, with_y, fake_ratio):
+    rng = np.random.default_rng(0)
+    for _ in range(TRIALS):
+        m = random_tensor(rng, (len(FEATURES), rng.integers(1, 6), rng.integers(2, 12)))
+        original = m.copy()
+        expected = pricenorm3d_reference(m, FEATURES, norm_method, fake_ratio, with_y)
+        assert_same(expected, pricenorm(m, FEATURES, norm_method, fake_ratio, with_y), fake_ratio)
+        assert_same(expected, pricenorm3d(m, FEATURES, norm_method, fake_ratio, with_y), fake_ratio)
+        np.testing.assert_array_equal(m, original)
+
+
+@pytest.mark.parametrize("norm_method", NORM_METHODS)
+@pytest.mark.parametrize("with_y", [True, False])
+@pytest.mark.parametrize("fake_ratio", FAKE_RATIOS)
+def test_pricenorm_batch_matches_pricenorm2d(norm_method, with_y, fake_ratio):
+    rng = np.random.default_rng(1)
+    for _ in range(TRIALS // 4):
+        m = random_tensor(rng, (rng.integers(1, 5), len(FEATURES), rng.integers(1, 6), rng.integers(2, 12)))
+        expected = np.stack([pricenorm3d_reference(sample, FEATURES, norm_method, fake_ratio, with_y) for sample in m])
+        assert_same(expected, pricenorm(m, FEATURES, norm_method, fake_ratio, with_y), fake_ratio)
+
+
+def test_pricenorm_without_reference_close():
+    m = np.array([[[1.0, 2.0, np.nan, 4.0]], [[2.0, np.nan, 6.0, 8.0]]])
+    expected = np.full(m.shape, 1.01)
+    expected[:, :, 0] = 1.01 ** -2
+    expected[:, :, 1] = 1.01 ** -1
+    expected[:, :, 2] = 1.0
+    np.testing.assert_allclose(pricenorm(m, ["close", "high"], "absolute", fake_ratio=1.01), expected, rtol=1e-12)
+    np.testing.assert_allclose(pricenorm3d_reference(m, ["close", "high"], "absolute", fake_ratio=1.01), expected, rtol=1e-12)
+
+
+def test_pricenorm_keeps_float32():
+    m = random_tensor(np.random.default_rng(2), (2, len(FEATURES), 3, 5)).astype(np.float32)
+    for norm_method in NORM_METHODS:
+        assert pricenorm(m, FEATURES, norm_method).dtype == np.float32
+
+
+def test_pricenorm_rejects_other_first_feature():
+    with pytest.raises(ValueError):
+        pricenorm(np.ones((2, 1, 3)), ["high", "close"], "absolute")
+    with pytest.raises(ValueError):
+        pricenorm(np.ones((1, 1, 3)), ["close"], "cumulative")
@@ -37,6 +37,13 @@ def fill_train_config(train_config: dict) -> None:
   set_missing(train_config, "fast_train", True)
   set_missing(train_config, "decay_rate", 1.0)
   set_missing(train_config, "decay_steps", 50000)
+  set_missing(train_config, "prefetch_batches", 2)
+  set_missing(train_config, "prefetch_mode", "exact")
+  set_missing(train_config, "evaluation_chunk_size", 2048)
+  set_missing(train_config, "input_pipeline", "feed_dict")
+  set_missing(train_config, "xla", False)
+  set_missing(train_config, "ensemble", False)
+  set_missing(train_config, "early_stopping_patience", 0)
 
 
 def fill_input_default(input_config: dict) -> None:
@@ -46,6 +53,12 @@ def fill_input_default(input_config: dict) -> None:
   set_missing(input_config, "norm_method", "absolute")
   set_missing(input_config, "is_permed", False)
   set_missing(input_config, "fake_ratio", 1)
+  set_missing(input_config, "fake_data", False)
+  set_missing(input_config, "download_workers", 4)
+  set_missing(input_config, "requests_per_second", 6)
+  set_missing(input_config, "panel_cache_size_mb", 2048)
+  set_missing(input_config, "data_dir", "")
+  set_missing(input_config, "storage_dtype", "float32")
 
 
 def fill_layers_default(layers: list[dict]) -> None:
@@ -9,16 +9,64 @@ def pricenorm3d(m, features, norm_method, fake_ratio=1.0, with_y=True):
     @:param with_y: if the tensor include y (future price)
         logging.debug("price are %s" % (self._latest_price_matrix[0, :, -1]))
     """
-    result = m.copy()
+    return pricenorm(m, features, norm_method, fake_ratio=fake_ratio, with_y=with_y)
+
+
+def pricenorm(m, features, norm_method, fake_ratio=1.0, with_y=True):
+    """vectorized pricenorm3d, gives the same results as calling pricenorm2d on every feature
+    @:param m: input tensor of shape [features, coins, windowsize] or [batch, features, coins, windowsize],
+    unnormalized and there could be nan in it, it is not modified
+    @:param with_y: if the tensor include y (future price)
+    @:return: the normalized copy of m
+    """
     if features[0] != "close":
         raise ValueError("first feature must be close")
-    for i, feature in enumerate(features):
-        if with_y:
-            one_position = 2
-        else:
-            one_position = 1
-        pricenorm2d(result[i], m[0, :, -one_position], norm_method=norm_method,
-                    fake_ratio=fake_ratio, one_position=one_position)
+    one_position = 2 if with_y else 1
+    m = np.asarray(m)
+    dtype = m.dtype if np.issubdtype(m.dtype, np.floating) else np.float64
+    if norm_method == "absolute":
+        # every feature of a coin is divided by the close of the coin
+        result = _pricenorm_absolute(m, m[..., 0, None, :, -one_position], fake_ratio, one_position)
+    elif norm_method == "relative":
+        result = _pricenorm_relative(m, fake_ratio)
+    else:
+        raise ValueError("there is no norm morthod called %s" % norm_method)
+    return result.astype(dtype, copy=False)
+
+
+def _pricenorm_absolute(m, reference, fake_ratio, one_position):
+    m = m.astype(np.float64)
+    length = m.shape[-1]
+    last = length - one_position
+    positions = np.arange(length)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normed = m / reference[..., None]
+
+    # rows without a reference price become the geometric sequence fake_ratio ** (position - last)
+    no_reference = np.isnan(m[..., last]) | np.isnan(reference)
+    fake_row = np.power(float(fake_ratio), np.minimum(positions - last, 0).astype(np.float64))
+    fake_row[-1] = fake_ratio
+
+    # nan up to last are back filled with the next valid value divided by fake_ratio for each step back
+    head = normed[..., :last + 1]
+    next_valid = np.where(np.isnan(head), length, positions[:last + 1])
+    next_valid = np.minimum.accumulate(next_valid[..., ::-1], axis=-1)[..., ::-1]
+    # rows without a reference are replaced anyway, point them to a valid position
+    next_valid = np.where(no_reference[..., None], last, next_valid)
+    filled = np.take_along_axis(head, next_valid, axis=-1) / np.power(float(fake_ratio), (next_valid - positions[:last + 1]).astype(np.float64))
+    normed[..., :last + 1] = filled
+    tail = normed[..., last + 1:]
+    tail[np.isnan(tail)] = fake_ratio
+
+    return np.where(no_reference[..., None], fake_row, normed)
+
+
+def _pricenorm_relative(m, fake_ratio):
+    result = np.empty(m.shape, dtype=np.float64)
+    result[..., 0] = fake_ratio
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.divide(m[..., 1:], m[..., :-1], out=result[..., 1:])
+    result[np.isnan(result)] = fake_ratio
     return result
 
 
@@ -57,15 +105,46 @@ def pricenorm2d(m, reference_column,
 
 
 def get_chart_until_success(polo, pair, start, period, end):
-    is_connect_success = False
-    chart = {}
-    while not is_connect_success:
-        try:
-            chart = polo.marketChart(pair=pair, start=int(start), period=int(period), end=int(end))
-            is_connect_success = True
-        except Exception as e:
-            print(e)
-    return chart
+    """fetch the chart of pair, the provider client retries failed requests with backoff
+    and raises once its retry budget is exhausted
+    """
+    return polo.marketChart(pair=pair, start=int(start), period=int(period), end=int(end))
+
+
+def merge_intervals(intervals, step=1):
+    """merge closed [start, end] intervals which overlap or are adjacent
+    @:param intervals: iterable of (start, end) tuples, in any order
+    @:param step: the resolution of the intervals, [a, b] and [b + step, c] are merged
+    @:return: sorted list of disjoint (start, end) tuples
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + step:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_intervals(start, end, intervals, step=1):
+    """return the parts of the closed interval [start, end] not covered by intervals
+    @:param intervals: sorted, disjoint (start, end) tuples, e.g. the result of merge_intervals
+    @:param step: the resolution of the intervals
+    @:return: sorted list of (start, end) tuples
+    """
+    missing = []
+    cursor = start
+    for covered_start, covered_end in intervals:
+        if covered_end < cursor:
+            continue
+        if covered_start > end:
+            break
+        if covered_start > cursor:
+            missing.append((cursor, covered_start - step))
+        cursor = max(cursor, covered_end + step)
+    if cursor <= end:
+        missing.append((cursor, end))
+    return missing
 
 
 def get_type_list(feature_number):
@@ -111,6 +190,36 @@ def get_volume_forward(time_span, portion, portion_reversed):
     return volume_forward
 
 
+def array_to_panel(array, coins, time_index, features):
+    """convert a [feature, coin, time] array to a multi index data frame indexed by (coin, time)
+    with one column per feature
+    """
+    multi_index = pd.MultiIndex.from_product([coins, time_index], names=["major", "minor"])
+    return pd.DataFrame(array.reshape(array.shape[0], -1).T, index=multi_index, columns=list(features))
+
+
+def array_fillna(array, type="bfill"):
+    """
+    fill nan along the last (time) axis of an array, equivalent to panel_fillna
+    :param array: the array to be filled, it is not modified
+    :param type: bfill, ffill or both (bfill then ffill)
+    """
+    if type == "both":
+        return _ffill(_ffill(array[..., ::-1])[..., ::-1])
+    elif type == "bfill":
+        return _ffill(array[..., ::-1])[..., ::-1]
+    elif type == "ffill":
+        return _ffill(array)
+    else:
+        raise ValueError("there is no fill type called %s" % type)
+
+
+def _ffill(array):
+    index = np.where(np.isnan(array), 0, np.arange(array.shape[-1]))
+    np.maximum.accumulate(index, axis=-1, out=index)
+    return np.take_along_axis(array, index, axis=-1)
+
+
 def panel_fillna(panel, type="bfill"):
     """
     fill nan along the 3rd axis
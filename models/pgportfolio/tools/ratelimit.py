@@ -0,0 +1,52 @@
+from __future__ import absolute_import, division, print_function
+import threading
+import time
+
+
+class TokenBucket:
+  """
+
+    Thread safe token bucket rate limiter.
+
+    Tokens are refilled continuously at `rate` tokens per second up to `capacity`.
+    Each call to acquire() takes one token, blocking until one is available.
+
+    Args:
+        rate (float): the number of tokens added per second. A rate <= 0 disables the limiter
+        capacity (float, optional): the maximum number of tokens that can be accumulated (the allowed burst). Defaults to rate.
+    """
+
+  def __init__(self, rate: float, capacity: float = None):
+    self._rate = float(rate)
+    self._capacity = float(capacity) if capacity is not None else max(self._rate, 1.0)
+    self._tokens = self._capacity
+    self._last_refill = time.monotonic()
+    self._lock = threading.Lock()
+
+  @property
+  def rate(self) -> float:
+    return self._rate
+
+  def acquire(self, tokens: float = 1.0) -> float:
+    """take tokens from the bucket, sleeping until they are available
+
+    Args:
+        tokens (float, optional): the number of tokens to take. Defaults to 1.0.
+
+    Returns:
+        float: the number of seconds spent waiting
+    """
+    if self._rate <= 0:
+      return 0.0
+    waited = 0.0
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+        if self._tokens >= tokens:
+          self._tokens -= tokens
+          return waited
+        wait = (tokens - self._tokens) / self._rate
+      time.sleep(wait)
+      waited += wait
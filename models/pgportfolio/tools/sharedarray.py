@@ -0,0 +1,80 @@
+from __future__ import absolute_import, division, print_function
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArray:
+  """
+
+    A numpy array backed by a named shared memory block, so that other processes can map it without a copy.
+
+    The creating process owns the block and unlinks it once the SharedArray is closed or garbage collected.
+    Other processes attach with SharedArray.attach(*shared.descriptor), the descriptor being a small picklable
+    tuple which can be passed to a child process or put on a queue. Child processes share the resource tracker
+    of their parent, so the block outlives them.
+
+    Args:
+        shm (shared_memory.SharedMemory): the shared memory block
+        shape (tuple): the shape of the array
+        dtype: the dtype of the array
+        owner (bool): True if the block is unlinked when this object is closed
+        readonly (bool, optional): True to map the array read only. Defaults to False.
+    """
+
+  def __init__(self, shm: shared_memory.SharedMemory, shape: tuple, dtype, owner: bool, readonly: bool = False):
+    self._shm = shm
+    self._owner = owner
+    self.array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    if readonly:
+      self.array.flags.writeable = False
+    self._finalizer = weakref.finalize(self, SharedArray._release, shm, owner)
+
+  @classmethod
+  def create(cls, shape: tuple, dtype=np.float32, fill=None) -> "SharedArray":
+    """allocates a new shared array, optionally filled with fill"""
+    nbytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    shared = cls(shared_memory.SharedMemory(create=True, size=nbytes), tuple(shape), dtype, owner=True)
+    if fill is not None:
+      shared.array[...] = fill
+    return shared
+
+  @classmethod
+  def from_array(cls, array: np.ndarray) -> "SharedArray":
+    """copies array into a new shared array"""
+    shared = cls.create(array.shape, array.dtype)
+    shared.array[...] = array
+    return shared
+
+  @classmethod
+  def attach(cls, name: str, shape: tuple, dtype, readonly: bool = False) -> "SharedArray":
+    """maps the shared array created by another process"""
+    return cls(shared_memory.SharedMemory(name=name), tuple(shape), dtype, owner=False, readonly=readonly)
+
+  @property
+  def name(self) -> str:
+    return self._shm.name
+
+  @property
+  def descriptor(self) -> tuple:
+    """(name, shape, dtype) as expected by attach"""
+    return self._shm.name, self.array.shape, self.array.dtype.str
+
+  def close(self) -> None:
+    """unmaps the array, and frees the shared memory if this process created it"""
+    self.array = None
+    self._finalizer()
+
+  @staticmethod
+  def _release(shm: shared_memory.SharedMemory, owner: bool) -> None:
+    try:
+      shm.close()
+    except BufferError:
+      # views of the array are still alive, the mapping is released with them
+      pass
+    if owner:
+      try:
+        shm.unlink()
+      except FileNotFoundError:
+        pass
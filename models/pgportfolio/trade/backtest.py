@@ -12,8 +12,8 @@ training_logger = get_custom_training_logger(__name__)
 
 class BackTest(trader.Trader):
 
-  def __init__(self, config, net_dir=None, agent=None, agent_type="nn"):
-    trader.Trader.__init__(self, 0, config, 0, net_dir, initial_BTC=1, agent=agent, agent_type=agent_type)
+  def __init__(self, config, net_dir=None, agent=None, agent_type="nn", global_data=None):
+    trader.Trader.__init__(self, 0, config, 0, net_dir, initial_BTC=1, agent=agent, agent_type=agent_type, global_data=global_data)
     if agent_type == "nn":
       data_matrices = self._rolling_trainer.data_matrices
     elif agent_type == "traditional":
@@ -51,6 +51,9 @@ class BackTest(trader.Trader):
   def _initialize_data_base(self):
     pass
 
+  def _update_data(self):
+    pass
+
   def _write_into_database(self):
     pass
 
@@ -73,7 +76,8 @@ class BackTest(trader.Trader):
   def trade_by_strategy(self, omega):
     logger.info(">> the step is: {} / {}".format(self._steps, self._total_steps))
     logger.debug("the raw omega is {}".format(omega))
-    future_price = np.concatenate((np.ones(1), self.__get_matrix_y()))
+    y = self.__get_matrix_y()
+    future_price = np.concatenate((np.ones(1, dtype=y.dtype), y))
     pv_after_commission = calculate_pv_after_commission(omega, self._last_omega, self._commission_rate)
     portfolio_change = pv_after_commission * np.dot(omega, future_price)
     self._total_capital *= portfolio_change
@@ -13,10 +13,11 @@ training_logger = get_custom_training_logger(__name__)
 
 class Trader:
 
-  def __init__(self, waiting_period, config, total_steps, net_dir, agent=None, initial_BTC=1.0, agent_type="nn"):
+  def __init__(self, waiting_period, config, total_steps, net_dir, agent=None, initial_BTC=1.0, agent_type="nn", global_data=None):
     """
         @:param agent_type: string, could be nn or traditional
         @:param agent: the traditional agent object, if the agent_type is traditional
+        @:param global_data: the global data of the rolling trainer, see DataMatrices.global_data, loaded from the database if None
         """
     self._steps = 0
     self._total_steps = total_steps
@@ -28,7 +29,7 @@ class Trader:
       config["input"]["norm_method"] = "relative"
       self._norm_method = "relative"
     elif agent_type == "nn":
-      self._rolling_trainer = RollingTrainer(config, net_dir, agent=agent)
+      self._rolling_trainer = RollingTrainer(config, net_dir, agent=agent, global_data=global_data)
       self._coin_name_list = self._rolling_trainer.coin_list
       self._norm_method = config["input"]["norm_method"]
       if not agent:
@@ -62,10 +63,17 @@ class Trader:
       logging_dict[coin] = 0
     self._logging_data_frame = pd.DataFrame(logging_dict, index=pd.to_datetime([time.time()], unit='s'))
 
+  def _update_data(self):
+    """appends the periods elapsed since the last update to the data matrices of the rolling trainer, see DataMatrices.extend
+        """
+    if self._agent_type == "nn":
+      self._rolling_trainer.data_matrices.extend(time.time())
+
   def generate_history_matrix(self):
-    """override this method to generate the input of agent
+    """override this method to generate the input of agent, by default the last window of the data matrices of the rolling trainer
         """
-    pass
+    if self._agent_type == "nn":
+      return self._rolling_trainer.data_matrices.get_latest_window()
 
   def finish_trading(self):
     pass
@@ -94,6 +102,7 @@ class Trader:
   def __trade_body(self):
     self._current_error_state = 'S000'
     starttime = time.time()
+    self._update_data()
     omega = self._agent.decide_by_history(self.generate_history_matrix(), self._last_omega.copy())
     self.trade_by_strategy(omega)
     if self._agent_type == "nn":